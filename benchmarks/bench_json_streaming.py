@@ -0,0 +1,79 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import trigger_ingestion  # noqa: E402
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Compare json.load with iter_json_array on a large validated file')
+    parser.add_argument('--resources', type=int, default='200000')
+    parser.add_argument('--issues-per-resource', type=int, default='5')
+    parser.add_argument('--file', help='Use an existing validated file instead of generating one')
+    parser.add_argument('--mode', choices=('load', 'stream'), help=argparse.SUPPRESS)
+    return parser.parse_args(args)
+
+
+def write_validated_file(file_name, num_resources, issues_per_resource):
+    with open(file_name, 'w') as f:
+        f.write('[')
+        for n in range(num_resources):
+            issues = [{
+                'severity': 'error' if i % 2 else 'information',
+                'diagnostics': f"Observation.code: None of the codings provided are in the value set (codes = http://loinc.org#{n}-{i})",
+                'location': [f"Observation.code.coding[{i}]"]
+            } for i in range(issues_per_resource)]
+            r = {'id': f"obs-{n}", 'resourceType': 'Observation', 'profile': 'http://cem/Lab', 'validations': {'issue': issues}}
+            if n:
+                f.write(',\n')
+            json.dump(r, f, indent=2)
+        f.write(']')
+
+
+def measure(mode, file_name):
+    start = time.time()
+    errors = 0
+    if mode == 'load':
+        with open(file_name, 'r') as f:
+            data = json.load(f)
+        for r in data:
+            errors += sum(1 for i in r['validations']['issue'] if i['severity'] == 'error')
+    else:
+        for r in trigger_ingestion.iter_json_array(file_name):
+            errors += sum(1 for i in r['validations']['issue'] if i['severity'] == 'error')
+    time_taken = time.time() - start
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'mode': mode, 'seconds': time_taken, 'peak_rss_mb': peak_rss_kb / 1024, 'errors': errors}))
+
+
+def main(args):
+    args = parse_args(args)
+    if args.mode:
+        measure(args.mode, args.file)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = args.file
+        if not file_name:
+            file_name = os.path.join(tmp_dir, 'validated.json')
+            write_validated_file(file_name, args.resources, args.issues_per_resource)
+        size_mb = os.path.getsize(file_name) / (1024 * 1024)
+        print(f"File size = {size_mb:.1f} MB")
+        print('%-8s' % 'mode', '%10s' % 'seconds', '%14s' % 'peak RSS (MB)')
+        for mode in ('load', 'stream'):
+            # Each mode runs in a fresh process so peak RSS is not shared between them
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), '--mode', mode, '--file', file_name],
+                                 check=True, capture_output=True, text=True).stdout
+            result = json.loads(out)
+            print('%-8s' % mode, '%10.2f' % result['seconds'], '%14.1f' % result['peak_rss_mb'])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
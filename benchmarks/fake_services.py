@@ -0,0 +1,263 @@
+import argparse
+import collections
+import datetime
+import heapq
+import http.server
+import itertools
+import json
+import os
+import random
+import shutil
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+
+
+class FakeServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, port, handler_class, latency=0.0, error_rate=0.0, seed=1):
+        super().__init__(('127.0.0.1', port), handler_class)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+class FakeHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def _handle(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        server = self.server
+        with server.lock:
+            server.counts[f"{method} {self.route(url.path)}"] += 1
+            fail = server.random.random() < server.error_rate
+        if server.latency:
+            time.sleep(server.latency)
+        if url.path == '/_stats':
+            status, response = 200, server.stats()
+        elif fail:
+            status, response = 503, {'detail': 'Injected failure'}
+        else:
+            status, response = self.dispatch(method, url.path, params, body)
+        self._send(status, response)
+
+    def _send(self, status, response):
+        # Headers and body go out in a single write, otherwise a small body can sit behind a delayed ACK
+        data = json.dumps(response).encode('utf-8')
+        head = (f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\n"
+                f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n").encode('latin-1')
+        self.wfile.write(head + data)
+        self.wfile.flush()
+
+    def route(self, path):
+        return path
+
+    def dispatch(self, method, path, params, body):
+        return 404, {'detail': 'Not found'}
+
+
+class FakeAirflow(FakeServer):
+    # Runs are queued and started in trigger order, at most `parallelism` at a time, like a scheduler with a
+    # fixed number of worker slots. Each run takes run_duration seconds, +/- jitter.
+    def __init__(self, port=0, latency=0.0, error_rate=0.0, run_duration=1.0, jitter=0.2, parallelism=32,
+                 failure_rate=0.0, template_run_dir=None, seed=1):
+        super().__init__(port, AirflowHandler, latency, error_rate, seed)
+        self.run_duration = run_duration
+        self.jitter = jitter
+        self.parallelism = parallelism
+        self.failure_rate = failure_rate
+        self.template_run_dir = template_run_dir
+        self.dag_runs = {}
+        self.order = []
+        self.queued = collections.deque()
+        self.running = []
+        self.slot_free_at = 0.0
+        self.seq = itertools.count()
+
+    def trigger(self, dag_id, dag_run_id, conf):
+        now = time.time()
+        with self.lock:
+            n = next(self.seq)
+            dag_run_id = dag_run_id or f"manual__{datetime.datetime.now(datetime.timezone.utc).isoformat()}_{n}"
+            if (dag_id, dag_run_id) in self.dag_runs:
+                return None
+            run = {
+                'dag_id': dag_id,
+                'dag_run_id': dag_run_id,
+                'conf': conf or {},
+                'execution_date': datetime.datetime.fromtimestamp(now, datetime.timezone.utc).isoformat(),
+                'state': 'queued',
+                'start_date': None,
+                'end_date': None,
+                '_created': now,
+                '_duration': max(self.run_duration * self.random.uniform(1 - self.jitter, 1 + self.jitter), 0.0),
+                '_failed': self.random.random() < self.failure_rate,
+            }
+            self.dag_runs[(dag_id, dag_run_id)] = run
+            self.order.append(run)
+            self.queued.append(run)
+            self._advance(now)
+            return self._public(run)
+
+    def get(self, dag_id, dag_run_id):
+        with self.lock:
+            self._advance(time.time())
+            run = self.dag_runs.get((dag_id, dag_run_id))
+            return self._public(run) if run else None
+
+    def list(self, dag_id, execution_date_gte=None, limit=100, offset=0):
+        with self.lock:
+            self._advance(time.time())
+            runs = [r for r in self.order if r['dag_id'] == dag_id and
+                    (not execution_date_gte or r['execution_date'] >= execution_date_gte)]
+            return {'dag_runs': [self._public(r) for r in runs[offset:offset + limit]], 'total_entries': len(runs)}
+
+    def _advance(self, now):
+        # Replays scheduler events up to now: start queued runs in free slots, finish runs whose time is up
+        while True:
+            while self.queued and len(self.running) < self.parallelism:
+                run = self.queued.popleft()
+                start = max(run['_created'], self.slot_free_at)
+                run['state'] = 'running'
+                run['_start'] = start
+                run['start_date'] = datetime.datetime.fromtimestamp(start, datetime.timezone.utc).isoformat()
+                heapq.heappush(self.running, (start + run['_duration'], id(run), run))
+            if not self.running or self.running[0][0] > now:
+                break
+            end, _, run = heapq.heappop(self.running)
+            self.slot_free_at = end
+            run['state'] = 'failed' if run['_failed'] else 'success'
+            run['end_date'] = datetime.datetime.fromtimestamp(end, datetime.timezone.utc).isoformat()
+            if run['state'] == 'success':
+                self._write_outputs(run)
+
+    def _write_outputs(self, run):
+        # Copies a template output file into the run dir so live analysis has something to read
+        conf = run['conf']
+        if not self.template_run_dir or 'workspace_dir' not in conf:
+            return
+        run_dir = os.path.join(conf['workspace_dir'], conf.get('parent_run_id', ''))
+        for file_name in conf.get('file_names') or [conf.get('file_name', '')]:
+            stem = os.path.splitext(os.path.basename(file_name))[0]
+            for d in ('validated', 'assigned', 'term_notifications'):
+                template = os.path.join(self.template_run_dir, d, stem + '.json')
+                if os.path.exists(template) and os.path.isdir(os.path.join(run_dir, d)):
+                    shutil.copyfile(template, os.path.join(run_dir, d, stem + '.json'))
+
+    @staticmethod
+    def _public(run):
+        return {k: v for k, v in run.items() if not k.startswith('_')}
+
+
+class AirflowHandler(FakeHandler):
+    def route(self, path):
+        parts = path.strip('/').split('/')
+        if len(parts) == 6 and parts[-2] == 'dagRuns':
+            return '/dags/{dag_id}/dagRuns/{dag_run_id}'
+        if len(parts) == 5 and parts[-1] == 'dagRuns':
+            return '/dags/{dag_id}/dagRuns'
+        return path
+
+    def dispatch(self, method, path, params, body):
+        parts = path.strip('/').split('/')
+        if len(parts) < 5 or parts[:2] != ['api', 'v1'] or parts[2] != 'dags' or parts[4] != 'dagRuns':
+            return 404, {'detail': 'Not found'}
+        dag_id = parts[3]
+        airflow = self.server
+        if len(parts) == 6 and method == 'GET':
+            run = airflow.get(dag_id, urllib.parse.unquote(parts[5]))
+            return (200, run) if run else (404, {'detail': 'DAGRun not found'})
+        if len(parts) == 5 and method == 'POST':
+            body = body or {}
+            run = airflow.trigger(dag_id, body.get('dag_run_id'), body.get('conf'))
+            return (200, run) if run else (409, {'detail': 'DAGRun already exists'})
+        if len(parts) == 5 and method == 'GET':
+            return 200, airflow.list(dag_id, params.get('execution_date_gte'), int(params.get('limit', 100)),
+                                     int(params.get('offset', 0)))
+        return 405, {'detail': 'Method not allowed'}
+
+
+class FakeTrackingService(FakeServer):
+    def __init__(self, port=0, latency=0.0, error_rate=0.0, seed=1):
+        super().__init__(port, TrackingHandler, latency, error_rate, seed)
+        self.created = collections.Counter()
+        self.notifications = collections.Counter()
+
+
+class TrackingHandler(FakeHandler):
+    def dispatch(self, method, path, params, body):
+        tracking = self.server
+        if method != 'POST':
+            return 405, {'detail': 'Method not allowed'}
+        if path == '/track/create':
+            with tracking.lock:
+                tracking.created[body.get('processType')] += 1
+            return 201, {'id': str(uuid.uuid4())}
+        if path == '/track/notifications':
+            with tracking.lock:
+                tracking.notifications[body.get('referenceType')] += len(body.get('notifications', []))
+            return 200, {'status': 'OK'}
+        return 404, {'detail': 'Not found'}
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Serve fake Airflow and tracking-service APIs for benchmarks')
+    parser.add_argument('--airflow-port', type=int, default='8080')
+    parser.add_argument('--tracking-port', type=int, default='8081')
+    parser.add_argument('--latency-ms', type=float, default='5', help='Added to every response')
+    parser.add_argument('--error-rate', type=float, default='0.0', help='Share of requests answered with a 503')
+    parser.add_argument('--run-duration', type=float, default='2.0', help='Seconds each dag run takes')
+    parser.add_argument('--jitter', type=float, default='0.2', help='Relative spread of run durations')
+    parser.add_argument('--parallelism', type=int, default='32', help='Dag runs running at the same time')
+    parser.add_argument('--failure-rate', type=float, default='0.0', help='Share of dag runs that end as failed')
+    parser.add_argument('--template-run-dir', help='Copy outputs from this run dir when a dag run succeeds')
+    return parser.parse_args(args)
+
+
+def main(args):
+    args = parse_args(args)
+    latency = args.latency_ms / 1000
+    airflow = FakeAirflow(args.airflow_port, latency, args.error_rate, args.run_duration, args.jitter,
+                          args.parallelism, args.failure_rate, args.template_run_dir).start()
+    tracking = FakeTrackingService(args.tracking_port, latency, args.error_rate).start()
+    print(f"INFO: Fake Airflow API at {airflow.base_url}/api/v1, fake tracking-service at {tracking.base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
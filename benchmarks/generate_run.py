@@ -0,0 +1,104 @@
+import argparse
+import json
+import os
+import random
+import sys
+
+ERROR_MESSAGES = [
+    "Observation.code: None of the codings provided are in the value set 'LOINC Codes' (http://loinc.org/vs), "
+    "and a coding is recommended to come from this value set) (codes = http://loinc.org#{code})",
+    "Observation.value.ofType(Quantity): Value {value} is not valid for unit '{unit}'",
+    "Profile http://hl7.org/fhir/StructureDefinition/{profile}, Element 'Observation.status': minimum required = 1, "
+    "but only found 0",
+    "Unable to resolve resource 'Patient/{patient}'",
+    "Observation.component[{index}].code: This element does not match any known slice defined in the profile",
+]
+UNITS = ['mg/dL', 'mmol/L', 'g/L', '%']
+PROFILES = ['cem-lab-observation', 'cem-vital-sign', 'cem-panel']
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Generate a synthetic run dir and input dir')
+    parser.add_argument('--files', type=int, default='100')
+    parser.add_argument('--resources-per-file', type=int, default='200')
+    parser.add_argument('--profile-rate', type=float, default='0.7', help='Share of resources with a CEM profile')
+    parser.add_argument('--max-errors', type=int, default='3', help='Max errors per profiled resource')
+    parser.add_argument('--codes', type=int, default='200', help='Number of distinct lab codes')
+    parser.add_argument('--unmapped-rate', type=float, default='0.3', help='Share of UNMAPPED terms')
+    parser.add_argument('--seed', type=int, default='1')
+    parser.add_argument('--input-dir', help='Also write one empty patient CSV per file here, as input for run')
+    parser.add_argument('run_dir')
+    return parser.parse_args(args)
+
+
+def generate_run(run_dir, files, resources_per_file, profile_rate=0.7, max_errors=3, codes=200, unmapped_rate=0.3,
+                 seed=1, input_dir=None):
+    rnd = random.Random(seed)
+    for d in ('standardized', 'assigned', 'validated', 'term_notifications'):
+        os.makedirs(os.path.join(run_dir, d), exist_ok=True)
+    if input_dir:
+        os.makedirs(input_dir, exist_ok=True)
+
+    for n in range(files):
+        patient = f"patient{n:06d}"
+        validated = []
+        entries = []
+        terms = []
+        for i in range(resources_per_file):
+            resource_id = f"{patient}-obs-{i}"
+            code = rnd.randrange(codes)
+            profiled = rnd.random() < profile_rate
+            resource = {
+                'resourceType': 'Observation',
+                'id': resource_id,
+                'status': 'final',
+                'subject': {'reference': f"Patient/{patient}"},
+                'code': {'coding': [
+                    {'system': 'urn:local:lab', 'code': f"L{code}", 'display': f"Local lab test {code}"},
+                    {'system': 'http://loinc.org', 'code': f"{code}-{code % 10}", 'display': f"Lab test {code}"},
+                ]},
+                'valueQuantity': {'value': rnd.randint(1, 500), 'unit': rnd.choice(UNITS)},
+            }
+            issues = [{'severity': 'information', 'diagnostics': 'Validation completed'}]
+            v = {'resourceType': 'Observation', 'id': resource_id, 'validations': {'issue': issues}}
+            if profiled:
+                profile = rnd.choice(PROFILES)
+                resource['meta'] = {'profile': [f"http://graphite/StructureDefinition/{profile}"]}
+                v['profile'] = profile
+                for _ in range(rnd.randint(0, max_errors)):
+                    message = rnd.choice(ERROR_MESSAGES).format(
+                        code=code, value=rnd.randint(1, 500), unit=rnd.choice(UNITS), profile=profile,
+                        patient=rnd.randint(1, 100000), index=rnd.randint(0, 3))
+                    issues.append({'severity': 'error', 'diagnostics': message, 'location': ['Observation.code']})
+            else:
+                issues.append({'severity': 'warning', 'diagnostics': 'No CEM profile matched this resource'})
+            validated.append(v)
+            entries.append({'fullUrl': f"urn:uuid:{resource_id}", 'resource': resource})
+            terms.append({
+                'mappingStatus': 'UNMAPPED' if rnd.random() < unmapped_rate else 'MAPPED',
+                'originalCode': f"L{code}",
+                'originalTerm': f"Local lab test {code}",
+                'originalCodeSystem': 'urn:local:lab',
+                'mapReference': None,
+                'category': 'LAB',
+            })
+
+        name = patient + '.json'
+        with open(os.path.join(run_dir, 'validated', name), 'w') as f:
+            json.dump(validated, f, indent=2)
+        with open(os.path.join(run_dir, 'assigned', name), 'w') as f:
+            json.dump({'resourceType': 'Bundle', 'type': 'collection', 'entry': entries}, f)
+        with open(os.path.join(run_dir, 'term_notifications', name), 'w') as f:
+            json.dump(terms, f)
+        if input_dir:
+            open(os.path.join(input_dir, patient + '.csv'), 'w').close()
+
+
+def main(args):
+    args = parse_args(args)
+    generate_run(args.run_dir, args.files, args.resources_per_file, args.profile_rate, args.max_errors, args.codes,
+                 args.unmapped_rate, args.seed, args.input_dir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,253 @@
+import argparse
+import contextlib
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+import fake_services  # noqa: E402
+import generate_run  # noqa: E402
+
+SCENARIOS = ['run', 'run-windowed', 'run-live', 'run-batched', 'analyze', 'analyze-parallel', 'analyze-cached',
+             'find-examples', 'find-least-errors', 'find-resource', 'show-matches', 'post-notifications',
+             'unmapped-terms']
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Benchmark trigger_ingestion commands against local fake services')
+    parser.add_argument('--files', type=int, default='100')
+    parser.add_argument('--resources-per-file', type=int, default='200')
+    parser.add_argument('--workers', type=int, default='4', help='Processes for the parallel analysis scenarios')
+    parser.add_argument('--concurrency', type=int, default='16', help='Concurrent requests for run and post-notifications')
+    parser.add_argument('--latency-ms', type=float, default='5', help='Added to every fake API response')
+    parser.add_argument('--error-rate', type=float, default='0.0', help='Share of API requests answered with a 503')
+    parser.add_argument('--run-duration', type=float, default='2.0', help='Seconds each fake dag run takes')
+    parser.add_argument('--parallelism', type=int, default='32', help='Fake dag runs running at the same time')
+    parser.add_argument('--files-per-batch', type=int, default='10', help='Input files per dag run in run-batched')
+    parser.add_argument('--scenarios', type=lambda s: s.split(','), default=SCENARIOS,
+                        help='Comma separated subset of ' + ','.join(SCENARIOS))
+    parser.add_argument('--data-dir', help='Keep generated data here and reuse it on later runs')
+    parser.add_argument('--output', help='Also write results as JSON to this file')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    return parser.parse_args(args)
+
+
+def run_child(spec_file):
+    # Runs one command in this fresh process, timing every API request and recording peak memory
+    with open(spec_file, 'r') as f:
+        spec = json.load(f)
+    import trigger_ingestion
+    if spec.get('airflow_url'):
+        trigger_ingestion.AIRFLOW_API_BASE_URL = spec['airflow_url']
+
+    latencies = []
+    request = trigger_ingestion.HttpClient.request
+
+    def timed_request(self, method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            return request(self, method, url, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    trigger_ingestion.HttpClient.request = timed_request
+    metrics_file = spec['result_file'] + '.metrics'
+    with open(spec['log_file'], 'w') as log, contextlib.redirect_stdout(log):
+        start = time.perf_counter()
+        trigger_ingestion.main(['--metrics-file', metrics_file] + spec['argv'])
+        seconds = time.perf_counter() - start
+    with open(metrics_file, 'r') as f:
+        calls = json.load(f)
+    result = {
+        'seconds': seconds,
+        'requests': len(latencies),
+        'latencies': sorted(latencies),
+        'calls': calls,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'peak_child_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+    with open(spec['result_file'], 'w') as f:
+        json.dump(result, f)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(len(sorted_values) * p / 100), len(sorted_values) - 1)]
+
+
+def measure(name, argv, items, unit, work_dir, airflow_url=None):
+    spec = {
+        'argv': argv,
+        'airflow_url': airflow_url,
+        'log_file': os.path.join(work_dir, name + '.log'),
+        'result_file': os.path.join(work_dir, name + '.json'),
+    }
+    spec_file = os.path.join(work_dir, name + '.spec.json')
+    with open(spec_file, 'w') as f:
+        json.dump(spec, f)
+    p = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', spec_file])
+    if p.returncode != 0:
+        print(f"WARN: Scenario {name} failed with exit code {p.returncode}, see {spec['log_file']}")
+        return None
+    with open(spec['result_file'], 'r') as f:
+        result = json.load(f)
+    latencies = result.pop('latencies')
+    result.update({
+        'scenario': name,
+        'items': items,
+        'unit': unit,
+        'throughput': items / max(result['seconds'], 1e-9),
+        'p50_ms': _ms(percentile(latencies, 50)),
+        'p95_ms': _ms(percentile(latencies, 95)),
+        'p99_ms': _ms(percentile(latencies, 99)),
+        'max_ms': _ms(latencies[-1] if latencies else None),
+    })
+    return result
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+def prepare_data(args, data_dir):
+    template_run = os.path.join(data_dir, 'template_run')
+    input_dir = os.path.join(data_dir, 'input')
+    params_file = os.path.join(data_dir, 'params.json')
+    params = {'files': args.files, 'resources_per_file': args.resources_per_file}
+    if os.path.exists(params_file):
+        with open(params_file, 'r') as f:
+            if json.load(f) == params:
+                print(f"INFO: Reusing generated data in {data_dir}")
+                return template_run, input_dir
+    shutil.rmtree(template_run, ignore_errors=True)
+    shutil.rmtree(input_dir, ignore_errors=True)
+    print(f"INFO: Generating {args.files} files with {args.resources_per_file} resources each in {data_dir}")
+    start = time.time()
+    generate_run.generate_run(template_run, args.files, args.resources_per_file, input_dir=input_dir)
+    print(f"INFO: Generated data in {time.time() - start:.2f} seconds")
+    with open(params_file, 'w') as f:
+        json.dump(params, f)
+    return template_run, input_dir
+
+
+def run_benchmarks(args, data_dir):
+    template_run, input_dir = prepare_data(args, data_dir)
+    work_dir = os.path.join(data_dir, 'results')
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    latency = args.latency_ms / 1000
+    airflow = fake_services.FakeAirflow(0, latency, args.error_rate, args.run_duration, 0.2, args.parallelism,
+                                        template_run_dir=template_run).start()
+    tracking = fake_services.FakeTrackingService(0, latency, args.error_rate).start()
+    airflow_url = airflow.base_url + '/api/v1'
+    files = args.files
+    resources = args.files * args.resources_per_file
+    workers = str(args.workers)
+    concurrency = str(args.concurrency)
+    last_id = f"patient{files - 1:06d}-obs-{args.resources_per_file - 1}"
+
+    # Commands that read a run dir get their own copy so caches, indexes and journals don't leak between them
+    def fresh_run_dir(name):
+        run_dir = os.path.join(work_dir, name + '-run')
+        shutil.copytree(template_run, run_dir)
+        return run_dir
+
+    def run_argv(name, *extra):
+        workspace_dir = os.path.join(work_dir, name + '-workspace')
+        os.makedirs(workspace_dir)
+        return ['run', '--input-dir', input_dir, '--workspace-dir', workspace_dir, '--concurrency', concurrency] + \
+            list(extra)
+
+    results = []
+    for name in args.scenarios:
+        if name == 'run':
+            result = measure(name, run_argv(name), files, 'files', work_dir, airflow_url)
+        elif name == 'run-windowed':
+            result = measure(name, run_argv(name, '--max-in-flight', str(args.parallelism)), files, 'files',
+                             work_dir, airflow_url)
+        elif name == 'run-live':
+            result = measure(name, run_argv(name, '--max-in-flight', str(args.parallelism), '--live-analysis',
+                                            '--analysis-workers', workers), files, 'files', work_dir, airflow_url)
+        elif name == 'run-batched':
+            result = measure(name, run_argv(name, '--max-in-flight', str(args.parallelism), '--max-files-per-batch',
+                                            str(args.files_per_batch)), files, 'files', work_dir, airflow_url)
+        elif name == 'analyze':
+            result = measure(name, ['analyze', '--no-cache', os.path.join(fresh_run_dir(name), 'validated')],
+                             resources, 'resources', work_dir)
+        elif name == 'analyze-parallel':
+            result = measure(name, ['analyze', '--no-cache', '--workers', workers,
+                                    os.path.join(fresh_run_dir(name), 'validated')], resources, 'resources', work_dir)
+        elif name == 'analyze-cached':
+            argv = ['analyze', '--workers', workers, os.path.join(fresh_run_dir(name), 'validated')]
+            measure(name + '-warmup', argv, resources, 'resources', work_dir)
+            result = measure(name, argv, resources, 'resources', work_dir)
+        elif name == 'find-examples':
+            result = measure(name, ['find-examples', '--error-string', 'Unable to resolve', '--limit', '10',
+                                    '--workers', workers, fresh_run_dir(name)], resources, 'resources', work_dir)
+        elif name == 'find-least-errors':
+            result = measure(name, ['find-least-errors', '--top-k', '10', '--workers', workers, fresh_run_dir(name)],
+                             resources, 'resources', work_dir)
+        elif name == 'find-resource':
+            result = measure(name, ['find-resource', '--id', last_id, fresh_run_dir(name)], resources, 'resources',
+                             work_dir)
+        elif name == 'show-matches':
+            result = measure(name, ['show-matches', '--no-cache', '--workers', workers, fresh_run_dir(name)],
+                             resources, 'resources', work_dir)
+        elif name == 'post-notifications':
+            result = measure(name, ['post-notifications', '--tracking-service-base-url', tracking.base_url,
+                                    '--client-id', 'bench', '--workers', concurrency, fresh_run_dir(name)],
+                             resources, 'resources', work_dir)
+        elif name == 'unmapped-terms':
+            result = measure(name, ['unmapped-terms', '--no-cache', '--workers', workers, '--post',
+                                    '--tracking-service-base-url', tracking.base_url, '--client-id', 'bench',
+                                    fresh_run_dir(name)], resources, 'resources', work_dir)
+        else:
+            print(f"WARN: Unknown scenario {name}, skipping")
+            continue
+        if result:
+            results.append(result)
+            print_result(result)
+
+    airflow.shutdown()
+    tracking.shutdown()
+    print()
+    print(f"INFO: Fake Airflow requests: {airflow.stats()}")
+    print(f"INFO: Fake tracking-service requests: {tracking.stats()}")
+    return results
+
+
+def print_result(r):
+    def fmt(v):
+        return '%8s' % ('-' if v is None else f"{v:.1f}")
+    print('%-20s' % r['scenario'], '%8.2fs' % r['seconds'], '%10.1f %-9s/s' % (r['throughput'], r['unit']),
+          '%6d req' % r['requests'], 'p50', fmt(r['p50_ms']), 'p95', fmt(r['p95_ms']), 'p99', fmt(r['p99_ms']),
+          'ms', ' rss %7.1f MB' % r['peak_rss_mb'], ' workers rss %7.1f MB' % r['peak_child_rss_mb'])
+
+
+def main(args):
+    args = parse_args(args)
+    if args.child:
+        run_child(args.child)
+        return
+    if args.data_dir:
+        os.makedirs(args.data_dir, exist_ok=True)
+        results = run_benchmarks(args, args.data_dir)
+    else:
+        with tempfile.TemporaryDirectory() as data_dir:
+            results = run_benchmarks(args, data_dir)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
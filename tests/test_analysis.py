@@ -0,0 +1,101 @@
+import json
+import os
+import shutil
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..'))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', 'benchmarks'))
+
+import generate_run  # noqa: E402
+import trigger_ingestion  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def run_dir(tmp_path_factory):
+    run_dir = str(tmp_path_factory.mktemp('run'))
+    generate_run.generate_run(run_dir, 6, 40)
+    trigger_ingestion.export_run(run_dir)
+    return run_dir
+
+
+def analyze(run_dir, **kwargs):
+    return trigger_ingestion.analyze(os.path.join(run_dir, 'validated'), 5, use_cache=False, **kwargs)
+
+
+@pytest.mark.parametrize('templates', [{}, {'error_templates': True, 'examples_per_template': 2}])
+def test_serial_parallel_and_export_agree(run_dir, templates):
+    serial = analyze(run_dir, **templates)
+    assert serial['total'] == 240
+    assert serial['top_errors']
+    assert analyze(run_dir, workers=2, **templates) == serial
+    assert analyze(run_dir, from_export=True, **templates) == serial
+
+
+def test_templates_group_raw_messages(run_dir):
+    raw = analyze(run_dir)
+    templates = analyze(run_dir, error_templates=True, examples_per_template=2)
+    assert len(templates['top_errors']) < len(raw['top_errors'])
+    assert sum(templates['top_errors'].values()) == sum(raw['top_errors'].values())
+    assert all(1 <= len(v) <= 2 for v in templates['error_examples'].values())
+
+
+def test_top_errors_stay_bounded():
+    analysis = trigger_ingestion.empty_analysis(max_error_keys=5)
+    total = 0
+    for i in range(100):
+        top_errors = {f"rare {i}-{j}": 1 for j in range(10)}
+        top_errors.update({f"common {j}": 10 for j in range(3)})
+        total += sum(top_errors.values())
+        trigger_ingestion.merge_analysis(analysis, {'total': 1, 'profile_assigned': 1, 'gold': [],
+                                                    'top_errors': top_errors})
+        assert len(analysis['top_errors']) <= 10
+    assert {f"common {j}": 1000 for j in range(3)}.items() <= analysis['top_errors'].items()
+    assert sum(analysis['top_errors'].values()) + analysis['other_errors'] == total
+
+
+def test_no_limit(run_dir):
+    assert analyze(run_dir, max_error_keys=0) == analyze(run_dir, max_error_keys=0, workers=2)
+    bounded = analyze(run_dir, max_error_keys=2)
+    assert len(bounded['top_errors']) <= 4
+    assert bounded['other_errors'] > 0
+
+
+def test_live_analysis_with_templates(run_dir):
+    params = {'error_templates': True, 'examples_per_template': 2}
+    live = trigger_ingestion.LiveAnalyzer(os.path.join(run_dir, 'validated'), params=params)
+    live.on_progress([{'state': 'success', 'conf': {'file_name': '/input/patient000001.csv'}}])
+    analysis = live.finish()
+    expected = analyze(run_dir, **params)
+    assert analysis['top_errors'] == expected['top_errors']
+    assert analysis['error_examples'].keys() == expected['error_examples'].keys()
+
+
+def test_compare(run_dir, tmp_path):
+    # In the second run, one resource lost its errors and the last one of the file is gone
+    run_b = str(tmp_path / 'b')
+    shutil.copytree(run_dir, run_b)
+    name = sorted(os.listdir(os.path.join(run_b, 'validated')))[0]
+    with open(os.path.join(run_b, 'validated', name), 'r') as f:
+        validated = json.load(f)
+    with open(os.path.join(run_b, 'assigned', name), 'r') as f:
+        assigned = json.load(f)
+    fixed = next(v for v in validated if 'profile' in v and any(i['severity'] == 'error'
+                                                                 for i in v['validations']['issue']))
+    fixed['validations']['issue'] = [i for i in fixed['validations']['issue'] if i['severity'] != 'error']
+    validated.pop()
+    assigned['entry'].pop()
+    with open(os.path.join(run_b, 'validated', name), 'w') as f:
+        json.dump(validated, f)
+    with open(os.path.join(run_b, 'assigned', name), 'w') as f:
+        json.dump(assigned, f)
+
+    assert trigger_ingestion.compare_runs(run_dir, run_dir)['gold_gained'] == 0
+    report = trigger_ingestion.compare_runs(run_dir, run_b, workers=2)
+    assert report['gold_gained_ids'] == [fixed['id']]
+    assert report['gold_lost'] == 0
+    assert (report['only_in_a'], report['only_in_b']) == (1, 0)
+    assert all(n < 0 for n in report['changed_templates'].values())
+    assert not report['new_templates']
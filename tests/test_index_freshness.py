@@ -0,0 +1,87 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import trigger_ingestion  # noqa: E402
+
+
+def write_file(run_dir, name, ids, profile='cem-lab-observation', error='Unable to resolve'):
+    validated = [{'resourceType': 'Observation', 'id': i, 'profile': profile,
+                  'validations': {'issue': [{'severity': 'error', 'diagnostics': f"{error} {i}"}]}} for i in ids]
+    coding = [{'system': 'urn:local', 'code': 'L1'}, {'system': 'http://loinc.org', 'code': '1-1', 'display': 'Lab'}]
+    entries = [{'resource': {'resourceType': 'Observation', 'id': i, 'meta': {'profile': [profile]},
+                             'code': {'coding': coding}}} for i in ids]
+    with open(os.path.join(run_dir, 'validated', name), 'w') as f:
+        json.dump(validated, f, indent=2)
+    with open(os.path.join(run_dir, 'assigned', name), 'w') as f:
+        json.dump({'resourceType': 'Bundle', 'entry': entries}, f, indent=2)
+
+
+def make_run(tmp_path):
+    run_dir = str(tmp_path)
+    os.makedirs(os.path.join(run_dir, 'validated'))
+    os.makedirs(os.path.join(run_dir, 'assigned'))
+    write_file(run_dir, 'a.json', ['a1', 'a2'])
+    write_file(run_dir, 'b.json', ['b1'])
+    return run_dir
+
+
+def test_index_reads_changed_and_new_files_directly(tmp_path):
+    run_dir = make_run(tmp_path)
+    trigger_ingestion.build_index(run_dir)
+    # Rewritten with a longer first resource, so the indexed offsets of a2 no longer point at it
+    write_file(run_dir, 'a.json', ['a0-with-a-longer-id', 'a2'], error='Changed')
+    write_file(run_dir, 'c.json', ['c1'])
+
+    [resource] = trigger_ingestion.find_resource_by_id(run_dir, 'a2')
+    assert resource['id'] == 'a2'
+    assert resource['validations']['issue'][0]['diagnostics'] == 'Changed a2'
+    assert trigger_ingestion.find_resource_by_id(run_dir, 'a1') == []
+    assert trigger_ingestion.find_resource_by_id(run_dir, 'c1')[0]['id'] == 'c1'
+    assert trigger_ingestion.find_resource_by_id(run_dir, 'b1')[0]['id'] == 'b1'
+
+    examples = trigger_ingestion.find_examples(run_dir, ['Unable to resolve'], [], [], 10)
+    assert sorted(r['id'] for r in examples) == ['b1', 'c1']
+
+
+def test_index_ignores_removed_files(tmp_path):
+    run_dir = make_run(tmp_path)
+    trigger_ingestion.build_index(run_dir)
+    os.remove(os.path.join(run_dir, 'validated', 'b.json'))
+    assert trigger_ingestion.find_resource_by_id(run_dir, 'b1') == []
+
+
+def test_stale_export_is_not_used(tmp_path):
+    run_dir = make_run(tmp_path)
+    trigger_ingestion.export_run(run_dir)
+    assert trigger_ingestion.load_fresh_export(run_dir) is not None
+    write_file(run_dir, 'c.json', ['c1'])
+    assert trigger_ingestion.load_fresh_export(run_dir) is None
+    analysis = trigger_ingestion.analyze(os.path.join(run_dir, 'validated'), 5, use_cache=False, from_export=True)
+    assert analysis['total'] == 4
+
+
+def test_export_includes_assigned_only_files(tmp_path):
+    run_dir = make_run(tmp_path)
+    os.remove(os.path.join(run_dir, 'validated', 'b.json'))
+    trigger_ingestion.export_run(run_dir)
+    export = trigger_ingestion.load_fresh_export(run_dir)
+    assert export is not None
+    matched = trigger_ingestion.find_matched_unmatched(run_dir)
+    assert matched['matched'] == {('http://loinc.org', '1-1', 'Lab'): 3}
+    assert trigger_ingestion.matched_unmatched_export(export) == matched
+    assert trigger_ingestion.analyze_export(export)['total'] == 2
+
+    # Changing the assigned-only file makes the export stale too
+    write_file(run_dir, 'b.json', ['b1', 'b2'])
+    os.remove(os.path.join(run_dir, 'validated', 'b.json'))
+    assert trigger_ingestion.load_fresh_export(run_dir) is None
+
+
+def test_from_export_without_export(tmp_path):
+    run_dir = make_run(tmp_path)
+    assert trigger_ingestion.load_fresh_export(run_dir) is None
+    analysis = trigger_ingestion.analyze(os.path.join(run_dir, 'validated'), 5, use_cache=False, from_export=True)
+    assert analysis['total'] == 3
@@ -0,0 +1,68 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import trigger_ingestion  # noqa: E402
+
+
+def write_array(file_name, elements, newline='\n', key=None):
+    # Pretty printed like the pipeline's output, with the requested line endings
+    data = {key: elements} if key else elements
+    text = json.dumps(data, indent=2, ensure_ascii=False).replace('\n', newline)
+    with open(file_name, 'w', encoding='utf-8', newline='') as f:
+        f.write(text)
+
+
+def resources(n, text=''):
+    return [{'id': f"r{i}", 'resourceType': 'Observation', 'note': f"{text} {i}"} for i in range(n)]
+
+
+@pytest.mark.parametrize('newline', ['\n', '\r\n'])
+@pytest.mark.parametrize('text', ['plain', 'Hämoglobin µg/dL 血红蛋白 🧪'])
+def test_offsets_round_trip(tmp_path, newline, text):
+    file_name = str(tmp_path / 'validated.json')
+    elements = resources(50, text)
+    write_array(file_name, elements, newline)
+    read = list(trigger_ingestion.iter_json_array(file_name, with_offsets=True))
+    assert [e for _, e in read] == elements
+    for offset, e in read:
+        assert trigger_ingestion.read_json_at(file_name, offset) == e
+
+
+@pytest.mark.parametrize('newline', ['\n', '\r\n'])
+def test_offsets_across_read_boundary(tmp_path, newline):
+    # Elements of about 10 KB of multi-byte text, so several of them straddle the 64 KiB read chunks
+    file_name = str(tmp_path / 'validated.json')
+    elements = resources(40, 'é' * 5000)
+    write_array(file_name, elements, newline)
+    assert os.path.getsize(file_name) > 4 * trigger_ingestion.JSON_READ_CHUNK_SIZE
+    read = list(trigger_ingestion.iter_json_array(file_name, with_offsets=True))
+    assert [e for _, e in read] == elements
+    for offset, e in read:
+        assert trigger_ingestion.read_json_at(file_name, offset) == e
+
+
+@pytest.mark.parametrize('newline', ['\n', '\r\n'])
+def test_offsets_under_key(tmp_path, newline):
+    file_name = str(tmp_path / 'assigned.json')
+    entries = [{'fullUrl': f"urn:uuid:r{i}", 'resource': r} for i, r in enumerate(resources(20, 'ü'))]
+    with open(file_name, 'w', encoding='utf-8', newline='') as f:
+        f.write(json.dumps({'resourceType': 'Bundle', 'type': 'collection', 'entry': entries}, indent=2,
+                           ensure_ascii=False).replace('\n', newline))
+    read = list(trigger_ingestion.iter_json_array(file_name, key='entry', with_offsets=True))
+    assert [e for _, e in read] == entries
+    for offset, e in read:
+        assert trigger_ingestion.read_json_at(file_name, offset) == e
+
+
+def test_empty_array_and_missing_key(tmp_path):
+    file_name = str(tmp_path / 'empty.json')
+    write_array(file_name, [], '\r\n')
+    assert list(trigger_ingestion.iter_json_array(file_name)) == []
+    with open(file_name, 'w') as f:
+        f.write('{"resourceType": "Bundle"}')
+    assert list(trigger_ingestion.iter_json_array(file_name, key='entry')) == []
@@ -0,0 +1,51 @@
+import os
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..'))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', 'benchmarks'))
+
+import generate_run  # noqa: E402
+import trigger_ingestion  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def run_dir(tmp_path_factory):
+    run_dir = str(tmp_path_factory.mktemp('run'))
+    generate_run.generate_run(run_dir, 6, 30, max_errors=4)
+    trigger_ingestion.export_run(run_dir)
+    return run_dir
+
+
+def least_errors_by_scan(run_dir, exclude, top_k):
+    # Every candidate, ranked by errors, then file order, then position in the file
+    candidates = []
+    for file_idx, vf in enumerate(os.listdir(os.path.join(run_dir, 'validated'))):
+        for pos, r in enumerate(trigger_ingestion.iter_json_array(os.path.join(run_dir, 'validated', vf))):
+            errors = [i['diagnostics'] for i in r['validations']['issue'] if i['severity'] == 'error']
+            if 'profile' in r and errors and not any(e in d for e in exclude for d in errors):
+                candidates.append((len(errors), file_idx, pos, r['id']))
+    return [resource_id for *_, resource_id in sorted(candidates)[:top_k]]
+
+
+@pytest.mark.parametrize('exclude', [[], ['Unable to resolve', 'minimum required']])
+@pytest.mark.parametrize('top_k', [1, 5, 40])
+def test_serial_parallel_and_export_agree(run_dir, exclude, top_k):
+    expected = least_errors_by_scan(run_dir, exclude, top_k)
+    assert expected
+    serial = trigger_ingestion.find_resources_with_least_errors(run_dir, exclude, top_k)
+    parallel = trigger_ingestion.find_resources_with_least_errors(run_dir, exclude, top_k, workers=2)
+    export = trigger_ingestion.least_errors_export(trigger_ingestion.RunExport.load(run_dir), run_dir, exclude, top_k)
+    assert [r['id'] for r in serial] == expected
+    assert parallel == serial
+    assert export == serial
+    assert all('validations' in r for r in serial)
+
+
+def test_top_k_below_one(run_dir):
+    assert trigger_ingestion.find_resources_with_least_errors(run_dir, [], 0) == []
+    assert trigger_ingestion.least_errors_export(trigger_ingestion.RunExport.load(run_dir), run_dir, [], 0) == []
+    with pytest.raises(SystemExit):
+        trigger_ingestion.parse_args(['find-least-errors', '--top-k', '0', run_dir])
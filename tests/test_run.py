@@ -0,0 +1,117 @@
+import contextlib
+import io
+import json
+import os
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..'))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', 'benchmarks'))
+
+import fake_services  # noqa: E402
+import generate_run  # noqa: E402
+import trigger_ingestion  # noqa: E402
+
+
+def write_inputs(input_dir, sizes):
+    os.makedirs(input_dir, exist_ok=True)
+    file_names = []
+    for i, size in enumerate(sizes):
+        file_name = os.path.join(input_dir, f"p{i}.csv")
+        with open(file_name, 'w') as f:
+            f.write('x' * size)
+        file_names.append(file_name)
+    return file_names
+
+
+@pytest.mark.parametrize('batch_mb, max_files_per_batch', [(0, 3), (0.001, 0), (0.001, 2)])
+def test_make_batches(tmp_path, batch_mb, max_files_per_batch):
+    sizes = [700, 100, 300, 50, 900, 200, 400, 10, 600, 250]
+    file_names = write_inputs(str(tmp_path), sizes)
+    batches = trigger_ingestion.make_batches(file_names, batch_mb, max_files_per_batch)
+    assert sorted(f for batch in batches for f in batch) == sorted(file_names)
+    assert all(batch == sorted(batch) for batch in batches)
+    if max_files_per_batch:
+        assert all(len(batch) <= max_files_per_batch for batch in batches)
+    if batch_mb and not max_files_per_batch:
+        # Packed into as few batches as the size allows, each within one file of the others
+        size = {f: s for f, s in zip(file_names, sizes)}
+        batch_sizes = [sum(size[f] for f in batch) for batch in batches]
+        assert len(batches) == -(-sum(sizes) // int(batch_mb * 1024 * 1024))
+        assert max(batch_sizes) - min(batch_sizes) <= max(sizes)
+    assert trigger_ingestion.make_batches(list(reversed(file_names)), batch_mb, max_files_per_batch) == batches
+
+
+@pytest.fixture
+def airflow(monkeypatch):
+    server = fake_services.FakeAirflow(run_duration=0.05, jitter=0.0).start()
+    monkeypatch.setattr(trigger_ingestion, 'AIRFLOW_API_BASE_URL', server.base_url + '/api/v1')
+    monkeypatch.setattr(trigger_ingestion, 'MIN_POLL_INTERVAL', 0.05)
+    yield server
+    server.shutdown()
+
+
+def run_quietly(argv):
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        trigger_ingestion.main(argv)
+    return out.getvalue()
+
+
+def test_resume_batched_run_with_failed_and_never_submitted_files(tmp_path, airflow):
+    input_dir = str(tmp_path / 'input')
+    workspace_dir = str(tmp_path / 'workspace')
+    os.makedirs(workspace_dir)
+    file_names = write_inputs(input_dir, [0] * 6)
+    airflow.failure_rate = 1.0
+    run_quietly(['run', '--input-dir', input_dir, '--workspace-dir', workspace_dir, '--run-id', 'r1',
+                 '--max-files-per-batch', '2'])
+    run_dir = os.path.join(workspace_dir, 'r1')
+    manifest_file = os.path.join(run_dir, trigger_ingestion.MANIFEST_FILE_NAME)
+    manifest = trigger_ingestion.RunManifest.load(manifest_file)
+    assert {v['state'] for v in manifest.files.values()} == {'failed'}
+    assert len(manifest.run_files) == 3
+
+    # p3 succeeded after all and p4 was never submitted, so the files left are packed differently, and a new batch
+    # starts with the same file as a failed one
+    p0, p1, p2, p3, p4, p5 = file_names
+    manifest.files[p3]['state'] = 'success'
+    manifest.files[p4] = {'dag_run_id': None, 'state': None, 'execution_date': None}
+    manifest.save(force=True)
+    failed_batches = trigger_ingestion.make_batches(file_names, 0, 2)
+    batches = trigger_ingestion.make_batches(trigger_ingestion.RunManifest.load(manifest_file).files_to_trigger(), 0, 2)
+    assert sum(len(batch) for batch in batches) == 5
+    assert any(b[0] == fb[0] and b != fb for b in batches for fb in failed_batches)
+
+    airflow.failure_rate = 0.0
+    run_quietly(['resume', run_dir])
+    manifest = trigger_ingestion.RunManifest.load(manifest_file)
+    assert {v['state'] for v in manifest.files.values()} == {'success'}
+    resumed = [run['conf']['file_names'] for run in airflow.dag_runs.values() if run['state'] == 'success']
+    assert sorted(resumed) == batches
+    assert len(airflow.dag_runs) == len(failed_batches) + len(batches)
+
+def test_sharded_run_merges_to_the_same_analysis(tmp_path, airflow):
+    template_run = str(tmp_path / 'template')
+    input_dir = str(tmp_path / 'input')
+    workspace_dir = str(tmp_path / 'workspace')
+    os.makedirs(workspace_dir)
+    generate_run.generate_run(template_run, 8, 20, input_dir=input_dir)
+    airflow.template_run_dir = template_run
+    for shard in ('0/3', '1/3', '2/3'):
+        run_quietly(['run', '--input-dir', input_dir, '--workspace-dir', workspace_dir, '--run-id', 'r1',
+                     '--shard', shard, '--error-templates'])
+    run_dir = os.path.join(workspace_dir, 'r1')
+    with contextlib.redirect_stdout(io.StringIO()):
+        merged = trigger_ingestion.merge_shards(run_dir, 10)
+        expected = trigger_ingestion.analyze(os.path.join(template_run, 'validated'), 10, use_cache=False,
+                                             error_templates=True)
+
+    assert len(os.listdir(os.path.join(run_dir, 'validated'))) == 8
+    for k in ('total', 'profile_assigned', 'gold_count', 'top_errors'):
+        assert merged[k] == expected[k]
+    with open(os.path.join(run_dir, trigger_ingestion.MANIFEST_FILE_NAME), 'r') as f:
+        files = json.load(f)['files']
+    assert len(files) == 8
+    assert {v['state'] for v in files.values()} == {'success'}
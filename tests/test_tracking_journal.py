@@ -0,0 +1,38 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import trigger_ingestion  # noqa: E402
+
+
+def test_resume_after_torn_last_line(tmp_path):
+    journal_file = str(tmp_path / 'journal.jsonl')
+    with open(journal_file, 'w') as f:
+        f.write('{"type": "segment", "file": "a.json", "id": "S1"}\n{"type": "destin')
+
+    journal = trigger_ingestion.TrackingJournal(journal_file, resume=True)
+    assert journal.segments == {'a.json': 'S1'}
+    journal.record(type='segment', file='b.json', id='S2')
+    journal.f.close()
+
+    journal = trigger_ingestion.TrackingJournal(journal_file, resume=True)
+    journal.f.close()
+    assert journal.segments == {'a.json': 'S1', 'b.json': 'S2'}
+
+
+def test_resume_keeps_complete_journal(tmp_path):
+    journal_file = str(tmp_path / 'journal.jsonl')
+    journal = trigger_ingestion.TrackingJournal(journal_file)
+    journal.record(type='request', id='R1')
+    journal.record(type='destination', file='a.json', resource='r1', id='D1')
+    journal.record(type='notified', file='a.json', resource='r1')
+    journal.f.close()
+    size = os.path.getsize(journal_file)
+
+    journal = trigger_ingestion.TrackingJournal(journal_file, resume=True)
+    journal.f.close()
+    assert os.path.getsize(journal_file) == size
+    assert journal.request_id == 'R1'
+    assert journal.notified == {('a.json', 'r1')}
+    assert journal.destinations == {}
@@ -0,0 +1,180 @@
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..'))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', 'benchmarks'))
+
+import fake_services  # noqa: E402
+import trigger_ingestion  # noqa: E402
+
+
+class LossyAirflowHandler(fake_services.AirflowHandler):
+    # Creates the first triggered run, but answers with a 502 as if a proxy had lost the response
+    def dispatch(self, method, path, params, body):
+        status, response = super().dispatch(method, path, params, body)
+        if method == 'POST' and status == 200 and not self.server.lost_response:
+            self.server.lost_response = True
+            return 502, {'detail': 'Bad gateway'}
+        return status, response
+
+
+@pytest.fixture
+def airflow(monkeypatch):
+    server = fake_services.FakeAirflow(run_duration=0.0, jitter=0.0)
+    server.RequestHandlerClass = LossyAirflowHandler
+    server.lost_response = False
+    server.start()
+    monkeypatch.setattr(trigger_ingestion, 'AIRFLOW_API_BASE_URL', server.base_url + '/api/v1')
+    monkeypatch.setattr(trigger_ingestion, '_airflow_client', trigger_ingestion.HttpClient(backoff=0.01))
+    yield server
+    server.shutdown()
+
+
+def test_retried_trigger_does_not_duplicate_the_run(airflow):
+    dag = trigger_ingestion.trigger_dag('ingest', '/input/p1.csv', '/workspace', 'run-1')
+    assert airflow.lost_response
+    assert dag['dag_run_id'] == 'run-1__p1.csv'
+    assert dag['conf']['file_name'] == '/input/p1.csv'
+    assert len(airflow.dag_runs) == 1
+
+
+def test_batch_gets_its_own_run_id(airflow):
+    dag = trigger_ingestion.trigger_dag('ingest', ['/input/p1.csv', '/input/p2.csv'], '/workspace', 'run-1')
+    assert dag['dag_run_id'].startswith('run-1__batch__p1.csv__')
+    assert len(airflow.dag_runs) == 1
+
+
+def test_run_ids_differ_for_different_files():
+    ids = {trigger_ingestion.dag_run_id_for(f, 'run-1') for f in
+           ['p 1.csv', 'p_1.csv', 'p\u00e41.csv', ['p1.csv', 'p2.csv'], ['p1.csv', 'p3.csv']]}
+    assert len(ids) == 5
+    assert trigger_ingestion.dag_run_id_for('p_1.csv', 'run-1') == 'run-1__p_1.csv'
+
+
+def test_failed_run_is_triggered_again_under_a_new_id(airflow):
+    airflow.failure_rate = 1.0
+    first = trigger_ingestion.trigger_dag('ingest', '/input/p 1.csv', '/workspace', 'run-1')
+    assert first['dag_run_id'] == trigger_ingestion.dag_run_id_for('/input/p 1.csv', 'run-1')
+    assert trigger_ingestion.get_dag_run_api('ingest', first['dag_run_id'])['state'] == 'failed'
+    airflow.failure_rate = 0.0
+    second = trigger_ingestion.trigger_dag('ingest', '/input/p 1.csv', '/workspace', 'run-1')
+    assert second['dag_run_id'] == first['dag_run_id'] + '__2'
+    assert len(airflow.dag_runs) == 2
+
+
+def test_failed_batch_repacked_with_other_files(airflow):
+    airflow.failure_rate = 1.0
+    first = trigger_ingestion.trigger_dag('ingest', ['/input/a.csv', '/input/b.csv'], '/workspace', 'run-1')
+    airflow.failure_rate = 0.0
+    second = trigger_ingestion.trigger_dag('ingest', ['/input/a.csv', '/input/c.csv'], '/workspace', 'run-1')
+    assert second['dag_run_id'] != first['dag_run_id']
+    assert second['conf']['file_names'] == ['/input/a.csv', '/input/c.csv']
+
+
+def test_run_id_taken_by_other_files_moves_on(airflow):
+    airflow.lost_response = True
+    dag_run_id = trigger_ingestion.dag_run_id_for('/input/a.csv', 'run-1')
+    trigger_ingestion.trigger_dag_api('ingest', conf={'file_name': '/other/a.csv'}, dag_run_id=dag_run_id)
+    dag = trigger_ingestion.trigger_dag('ingest', '/input/a.csv', '/workspace', 'run-1')
+    assert dag['dag_run_id'] == dag_run_id + '__2'
+    assert dag['conf']['file_name'] == '/input/a.csv'
+
+
+def test_create_requests_are_not_retried_after_a_bad_gateway(monkeypatch):
+    server = fake_services.FakeTrackingService(error_rate=0.0)
+    server.RequestHandlerClass = type('BadGatewayHandler', (fake_services.TrackingHandler,), {
+        'dispatch': lambda self, method, path, params, body: (502, {'detail': 'Bad gateway'})})
+    server.start()
+    try:
+        monkeypatch.setattr(trigger_ingestion, '_tracking_client', trigger_ingestion.HttpClient(backoff=0.01))
+        with pytest.raises(trigger_ingestion.ApiException):
+            trigger_ingestion._create_request('client', server.base_url)
+        assert server.stats() == {'POST /track/create': 1}
+    finally:
+        server.shutdown()
+
+
+def test_poll_counts_runs_of_other_parent_runs(airflow):
+    # Runs of another shard, triggered after this one's, are listed too
+    airflow.run_duration = 60.0
+    tracker = trigger_ingestion.DagRunTracker()
+    for i in range(3):
+        tracker.update(trigger_ingestion.trigger_dag('ingest', f"/input/p{i}.csv", '/workspace', 'run-1'))
+    for i in range(2 * trigger_ingestion.DAG_RUNS_PAGE_LIMIT):
+        trigger_ingestion.trigger_dag('ingest', f"/input/q{i}.csv", '/workspace', 'run-1')
+
+    # The first poll can only guess from its own 3 runs and lists them, which pages through all 203
+    trigger_ingestion.poll_dag_runs('ingest', tracker)
+    assert tracker.total_entries == 2 * trigger_ingestion.DAG_RUNS_PAGE_LIMIT + 3
+    assert airflow.stats()['GET /dags/{dag_id}/dagRuns'] == 3
+
+    # 3 pages for 3 unfinished runs, so they are fetched one by one from now on
+    gets = airflow.stats().get('GET /dags/{dag_id}/dagRuns/{dag_run_id}', 0)
+    trigger_ingestion.poll_dag_runs('ingest', tracker)
+    assert airflow.stats()['GET /dags/{dag_id}/dagRuns'] == 3
+    assert airflow.stats()['GET /dags/{dag_id}/dagRuns/{dag_run_id}'] == gets + 3
+
+
+def serve_and_drop():
+    # Reads each request, then closes the connection without answering, like a server that dies mid-request
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen()
+    accepted = []
+
+    def serve():
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+            accepted.append(conn.recv(65536))
+            conn.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server, accepted
+
+
+def test_create_requests_are_not_retried_after_a_dropped_connection(monkeypatch):
+    server, accepted = serve_and_drop()
+    with server:
+        monkeypatch.setattr(trigger_ingestion, '_tracking_client', trigger_ingestion.HttpClient(backoff=0.01))
+        with pytest.raises(trigger_ingestion.ApiException):
+            trigger_ingestion._create_request('client', f"http://127.0.0.1:{server.getsockname()[1]}")
+        assert trigger_ingestion.tracking_client().requests_sent == 1
+        assert len(accepted) == 1
+
+
+def test_create_requests_are_retried_when_no_connection_was_made(monkeypatch):
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    client = trigger_ingestion.HttpClient(max_retries=2, backoff=0.01)
+    monkeypatch.setattr(trigger_ingestion, '_tracking_client', client)
+    with pytest.raises(trigger_ingestion.ApiException):
+        trigger_ingestion._create_request('client', f"http://127.0.0.1:{port}")
+    assert client.requests_sent == 3
+
+
+def test_run_windowed_waits_between_polls(airflow, monkeypatch):
+    # Runs finish in every cycle, which used to skip the wait before the next poll
+    airflow.run_duration = 0.02
+    monkeypatch.setattr(trigger_ingestion, 'MIN_POLL_INTERVAL', 0.02)
+    sleeps = []
+    polls = []
+    sleep = trigger_ingestion.time.sleep
+    poll_dag_runs = trigger_ingestion.poll_dag_runs
+    monkeypatch.setattr(trigger_ingestion.time, 'sleep', lambda seconds: sleeps.append(seconds) or sleep(seconds))
+    monkeypatch.setattr(trigger_ingestion, 'poll_dag_runs', lambda *args: polls.append(1) or poll_dag_runs(*args))
+
+    files = [f"/input/p{i}.csv" for i in range(20)]
+    dag_runs = trigger_ingestion.run_windowed('ingest', files, '/workspace', 'run-1', max_in_flight=4)
+    assert len(dag_runs) == 20
+    assert all(run['state'] == 'success' for run in dag_runs.values())
+    polling_sleeps = [s for s in sleeps if s >= 0.02]
+    assert len(polls) <= len(polling_sleeps) + 1
@@ -1,13 +1,32 @@
 import argparse
+import array
+import bisect
 import collections
+import concurrent.futures
+import contextlib
+import cProfile
+import functools
+import heapq
+import io
+import itertools
 import json
+import mmap
 import os
 import pprint
+import pstats
+import random
+import re
+import shutil
+import sqlite3
 import sys
+import tempfile
+import threading
 import time
 import typing
+import zlib
 
 import requests
+import urllib3
 
 import datetime
 
@@ -15,13 +34,319 @@ AIRFLOW_API_BASE_URL = 'http://host.docker.internal:8080/api/v1'
 AIRFLOW_USER = 'airflow'
 AIRFLOW_PASSWORD = 'airflow'
 
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# A POST that isn't idempotent may have been applied when a 500, 502 or 504 comes back or the response times out
+NON_IDEMPOTENT_RETRY_STATUS_CODES = (429, 503)
+MAX_BACKOFF_SECONDS = 30
+
+TERMINAL_STATES = ('success', 'failed')
+DAG_RUNS_PAGE_LIMIT = 100
+MIN_POLL_INTERVAL = 1.0
+MAX_POLL_INTERVAL = 30.0
+POLL_BACKOFF_FACTOR = 1.5
+POLL_CONCURRENCY = 8
+GOLD_SAMPLE_SIZE = 10
+MAX_ERROR_KEYS = 10000
+JSON_READ_CHUNK_SIZE = 1 << 16
+
+_JSON_DECODER = json.JSONDecoder()
+
+CACHE_FILE_NAME = 'analysis_cache.sqlite'
+INDEX_FILE_NAME = 'index.sqlite'
+TRACKING_JOURNAL_FILE_NAME = 'post_notifications.journal'
+MANIFEST_FILE_NAME = 'manifest.json'
+ANALYSIS_FILE_NAME = 'analysis.json'
+MANIFEST_SAVE_INTERVAL = 5.0
+MANIFEST_SUBMISSIONS_SAVE_INTERVAL = 1.0
+INDEX_SCHEMA = '''
+CREATE TABLE resources (
+    id TEXT NOT NULL,
+    validated_file TEXT NOT NULL,
+    validated_offset INTEGER,
+    assigned_offset INTEGER,
+    resource_type TEXT,
+    profile TEXT,
+    error_count INTEGER NOT NULL,
+    system TEXT,
+    code TEXT,
+    display TEXT,
+    matched INTEGER NOT NULL
+);
+CREATE TABLE errors (
+    resource_rowid INTEGER NOT NULL,
+    diagnostics TEXT NOT NULL
+);
+CREATE TABLE files (
+    validated_file TEXT PRIMARY KEY,
+    validated_size INTEGER,
+    validated_mtime_ns INTEGER,
+    assigned_size INTEGER,
+    assigned_mtime_ns INTEGER
+);
+'''
+INDEX_INDEXES = '''
+CREATE INDEX resources_id ON resources (id);
+CREATE INDEX errors_resource_rowid ON errors (resource_rowid);
+'''
+
+EXPORT_DIR_NAME = 'export'
+EXPORT_NONE = -1
+EXPORT_NO_OFFSET = (1 << 64) - 1
+EXPORT_COLUMNS = {
+    'id': 'I',
+    'file': 'I',
+    'validated_offset': 'Q',
+    'assigned_offset': 'Q',
+    'resource_type': 'i',
+    'profile': 'i',
+    'error_count': 'I',
+    'error_offsets': 'Q',
+    'diagnostics': 'I',
+    'system': 'i',
+    'code': 'i',
+    'display': 'i',
+    'matched': 'B',
+}
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRIC_PERCENTILES = (50, 95, 99)
+PROMETHEUS_PREFIX = 'trigger_ingestion'
+
 
 class ApiException(Exception):
     pass
 
 
+class DagRunExists(ApiException):
+    def __init__(self, message, retried=False):
+        super().__init__(message)
+        # True if the run was most likely created by an earlier attempt of the same request
+        self.retried = retried
+
+
+class RateLimiter:
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class Metrics:
+    # Latency histograms and request / byte counters per instrumented call. Snapshots are plain dicts, so worker
+    # processes can send theirs back with their results and the parent merges them.
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, seconds, error=False, attempts=0, bytes_sent=0, bytes_received=0):
+        with self.lock:
+            c = self.calls.get(name)
+            if c is None:
+                c = self.calls[name] = {'count': 0, 'errors': 0, 'attempts': 0, 'bytes_sent': 0, 'bytes_received': 0,
+                                        'seconds': 0.0, 'max_seconds': 0.0,
+                                        'buckets': [0] * (len(METRIC_BUCKETS) + 1)}
+            c['count'] += 1
+            c['errors'] += int(error)
+            c['attempts'] += attempts
+            c['bytes_sent'] += bytes_sent
+            c['bytes_received'] += bytes_received
+            c['seconds'] += seconds
+            c['max_seconds'] = max(c['max_seconds'], seconds)
+            c['buckets'][bisect.bisect_left(METRIC_BUCKETS, seconds)] += 1
+
+    def snapshot(self) -> typing.Dict:
+        with self.lock:
+            return {name: dict(c, buckets=list(c['buckets'])) for name, c in self.calls.items()}
+
+    def merge(self, snapshot: typing.Dict):
+        with self.lock:
+            for name, s in snapshot.items():
+                c = self.calls.get(name)
+                if c is None:
+                    self.calls[name] = dict(s, buckets=list(s['buckets']))
+                    continue
+                for k in ('count', 'errors', 'attempts', 'bytes_sent', 'bytes_received', 'seconds'):
+                    c[k] += s[k]
+                c['max_seconds'] = max(c['max_seconds'], s['max_seconds'])
+                c['buckets'] = [x + y for x, y in zip(c['buckets'], s['buckets'])]
+
+    def summary(self) -> typing.Dict:
+        result = {}
+        for name, c in sorted(self.snapshot().items()):
+            s = {k: c[k] for k in ('count', 'errors', 'attempts', 'bytes_sent', 'bytes_received')}
+            s['seconds'] = c['seconds']
+            s['mean_ms'] = c['seconds'] / c['count'] * 1000 if c['count'] else 0.0
+            for p in METRIC_PERCENTILES:
+                s[f"p{p}_ms"] = _bucket_percentile(c, p) * 1000
+            s['max_ms'] = c['max_seconds'] * 1000
+            s['buckets'] = {str(le): n for le, n in zip(METRIC_BUCKETS + ('+Inf',), itertools.accumulate(c['buckets']))}
+            result[name] = s
+        return result
+
+    def write_json(self, file_name):
+        _write_atomic(file_name, json.dumps(self.summary(), indent=2))
+
+    def write_prometheus(self, file_name):
+        # Text exposition format, for node_exporter's textfile collector or a similar scraper
+        calls = sorted(self.snapshot().items())
+        lines = [f"# HELP {PROMETHEUS_PREFIX}_call_seconds Latency of instrumented calls",
+                 f"# TYPE {PROMETHEUS_PREFIX}_call_seconds histogram"]
+        for name, c in calls:
+            for le, n in zip(METRIC_BUCKETS + ('+Inf',), itertools.accumulate(c['buckets'])):
+                lines.append(f'{PROMETHEUS_PREFIX}_call_seconds_bucket{{call="{name}",le="{le}"}} {n}')
+            lines.append(f'{PROMETHEUS_PREFIX}_call_seconds_sum{{call="{name}"}} {c["seconds"]}')
+            lines.append(f'{PROMETHEUS_PREFIX}_call_seconds_count{{call="{name}"}} {c["count"]}')
+        for k, help_text in (('errors', 'Instrumented calls that failed'),
+                             ('attempts', 'HTTP attempts of instrumented calls, retries included'),
+                             ('bytes_sent', 'Request body bytes sent'),
+                             ('bytes_received', 'Response body or file bytes read')):
+            lines.append(f"# HELP {PROMETHEUS_PREFIX}_call_{k}_total {help_text}")
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_call_{k}_total counter")
+            for name, c in calls:
+                lines.append(f'{PROMETHEUS_PREFIX}_call_{k}_total{{call="{name}"}} {c[k]}')
+        _write_atomic(file_name, '\n'.join(lines) + '\n')
+
+
+def _bucket_percentile(c: typing.Dict, p: float) -> float:
+    # Upper bound of the bucket holding the p-th percentile, capped at the largest value seen
+    rank = c['count'] * p / 100
+    for le, n in zip(METRIC_BUCKETS, itertools.accumulate(c['buckets'])):
+        if n >= rank and n:
+            return min(le, c['max_seconds'])
+    return c['max_seconds']
+
+
+def _write_atomic(file_name, text):
+    tmp_file = file_name + '.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(text)
+    os.replace(tmp_file, file_name)
+
+
+_metrics = Metrics()
+
+
+def metrics() -> Metrics:
+    return _metrics
+
+
+def _call_with_metrics(fn, item):
+    # Runs in a worker process: returns fn's result with the metrics it recorded, for the parent to merge
+    global _metrics
+    _metrics = Metrics()
+    return fn(item), _metrics.snapshot()
+
+
+class HttpClient:
+    def __init__(self, pool_size=10, rate_limit=0.0, max_retries=5, backoff=0.5, auth=None):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.auth = auth
+        self.limiter = RateLimiter(rate_limit)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.requests_sent = 0
+        self.lock = threading.Lock()
+
+    def request(self, method, url, metric=None, idempotent=True, **kwargs) -> requests.Response:
+        # With metric, the call's latency (retries and backoff included), attempts and bytes are recorded under it.
+        # Without idempotent, only failures where the server can't have received the request are retried.
+        retry_status_codes = RETRY_STATUS_CODES if idempotent else NON_IDEMPOTENT_RETRY_STATUS_CODES
+        start = time.perf_counter()
+        attempt = 0
+        bytes_sent = 0
+        response = None
+        try:
+            while True:
+                self.limiter.acquire()
+                with self.lock:
+                    self.requests_sent += 1
+                try:
+                    r = self.session.request(method, url, **kwargs)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    if attempt >= self.max_retries or not (idempotent or _not_connected(e)):
+                        raise ApiException(f"Request to {url} failed after {attempt + 1} attempts: {e}")
+                    delay = self._delay(attempt)
+                else:
+                    bytes_sent += len(r.request.body or b'')
+                    if r.status_code not in retry_status_codes or attempt >= self.max_retries:
+                        r.attempts = attempt + 1
+                        response = r
+                        return r
+                    delay = self._delay(attempt, r.headers.get('Retry-After'))
+                attempt += 1
+                time.sleep(delay)
+        finally:
+            if metric:
+                failed = response is None or response.status_code // 100 != 2
+                received = len(response.content) if response is not None else 0
+                metrics().observe(metric, time.perf_counter() - start, error=failed, attempts=attempt + 1,
+                                  bytes_sent=bytes_sent, bytes_received=received)
+
+    def _delay(self, attempt, retry_after=None) -> float:
+        if retry_after:
+            try:
+                return min(float(retry_after), MAX_BACKOFF_SECONDS)
+            except ValueError:
+                pass
+        delay = min(self.backoff * (2 ** attempt), MAX_BACKOFF_SECONDS)
+        return random.uniform(delay / 2, delay)
+
+
+def _not_connected(e: requests.RequestException) -> bool:
+    # A connection that dropped or timed out after it was made may have delivered the request
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    reason = e.args[0] if e.args else None
+    return isinstance(getattr(reason, 'reason', reason), urllib3.exceptions.NewConnectionError)
+
+
+_airflow_client = None
+
+
+def airflow_client() -> HttpClient:
+    global _airflow_client
+    if _airflow_client is None:
+        _airflow_client = HttpClient(auth=(AIRFLOW_USER, AIRFLOW_PASSWORD))
+    return _airflow_client
+
+
+def configure_airflow_client(**kwargs):
+    global _airflow_client
+    _airflow_client = HttpClient(auth=(AIRFLOW_USER, AIRFLOW_PASSWORD), **kwargs)
+
+
+_tracking_client = None
+
+
+def tracking_client() -> HttpClient:
+    global _tracking_client
+    if _tracking_client is None:
+        _tracking_client = HttpClient()
+    return _tracking_client
+
+
+def configure_tracking_client(**kwargs):
+    global _tracking_client
+    _tracking_client = HttpClient(**kwargs)
+
+
 def parse_args(args):
     parser = argparse.ArgumentParser()
+    parser.add_argument('--metrics-file', help='Write per-call latency, request and byte metrics as JSON to this file')
+    parser.add_argument('--prometheus-file', help='Also write the metrics in Prometheus text format to this file')
+    parser.add_argument('--profile', help='Write cProfile stats of the main process to this file, and a text report next to it')
     subparsers = parser.add_subparsers()
 
     parser_run = subparsers.add_parser('run')
@@ -31,33 +356,57 @@ def parse_args(args):
     parser_run.add_argument('--run-id-prefix', default='')
     parser_run.add_argument('--limit', type=int, default='0')
     parser_run.add_argument('--patients', type=csv, default='')
+    parser_run.add_argument('--run-id', help='Use this run id instead of one made from the current time, required with --shard')
+    add_run_options(parser_run)
     parser_run.set_defaults(func=run_subcmd)
 
+    parser_resume = subparsers.add_parser('resume')
+    add_run_options(parser_resume)
+    parser_resume.add_argument('run_dir')
+    parser_resume.set_defaults(func=resume_subcmd)
+
     parser_analyze = subparsers.add_parser('analyze')
     parser_analyze.add_argument('--num-top-errors', type=int, default='10')
+    parser_analyze.add_argument('--workers', type=int, default='1', help='Number of processes, 0 to use all cores')
+    parser_analyze.add_argument('--no-cache', action='store_true', help='Re-analyze every file, ignoring cached results')
+    parser_analyze.add_argument('--error-templates', action='store_true', help='Group errors by message template, with ids, values and paths replaced')
+    parser_analyze.add_argument('--examples-per-template', type=int, default='0', help='Raw messages to keep for each error template')
+    parser_analyze.add_argument('--max-error-keys', type=int, default=MAX_ERROR_KEYS, help='Distinct errors or templates to keep counts for, 0 for no limit')
+    parser_analyze.add_argument('--from-export', action='store_true', help='Read the export of the run dir instead of the validated files')
     parser_analyze.add_argument('validation_dir')
     parser_analyze.set_defaults(func=analyze_subcmd)
 
     parser_find_exampels = subparsers.add_parser('find-examples')
-    parser_find_exampels.add_argument('--error-string', default='')
+    parser_find_exampels.add_argument('--error-string', action='append', help='Can be repeated, matches any of them')
     parser_find_exampels.add_argument('--limit', type=int, default='1')
-    parser_find_exampels.add_argument('--code')
-    parser_find_exampels.add_argument('--code-display')
+    parser_find_exampels.add_argument('--code', action='append', help='Can be repeated, matches any of them')
+    parser_find_exampels.add_argument('--code-display', action='append', help='Can be repeated, matches any of them')
+    parser_find_exampels.add_argument('--workers', type=int, default='1', help='Number of processes, 0 to use all cores')
     parser_find_exampels.add_argument('run_dir')
     parser_find_exampels.set_defaults(func=find_examples_subcmd)
 
     parser_find_least_errors = subparsers.add_parser('find-least-errors')
     parser_find_least_errors.add_argument('--exclude-error-strings', default='', type=pipe_separated)
+    parser_find_least_errors.add_argument('--top-k', type=positive_int, default='1', help='Number of resources to return')
+    parser_find_least_errors.add_argument('--workers', type=int, default='1', help='Number of processes, 0 to use all cores')
+    parser_find_least_errors.add_argument('--from-export', action='store_true', help='Read the export of the run dir instead of the validated files')
     parser_find_least_errors.add_argument('run_dir')
     parser_find_least_errors.set_defaults(func=find_least_errors_subcmd)
 
     parser_show_matches = subparsers.add_parser('show-matches')
+    parser_show_matches.add_argument('--workers', type=int, default='1', help='Number of processes, 0 to use all cores')
+    parser_show_matches.add_argument('--no-cache', action='store_true', help='Re-read every file, ignoring cached results')
+    parser_show_matches.add_argument('--from-export', action='store_true', help='Read the export of the run dir instead of the assigned files')
     parser_show_matches.add_argument('run_dir')
     parser_show_matches.set_defaults(func=show_matched_unmatched_subcmd)
 
     parser_post_notifications = subparsers.add_parser('post-notifications')
     parser_post_notifications.add_argument('--tracking-service-base-url', default='http://localhost:8081')
     parser_post_notifications.add_argument('--client-id', required=True)
+    parser_post_notifications.add_argument('--workers', type=int, default='8', help='Number of concurrent requests to the tracking-service')
+    parser_post_notifications.add_argument('--max-retries', type=int, default='5')
+    parser_post_notifications.add_argument('--resume', action='store_true', help='Skip work recorded in the journal of an earlier, interrupted run')
+    parser_post_notifications.add_argument('--no-terminology', action='store_true', help="Don't post unmapped terms per segment, e.g. when unmapped-terms --post is used instead")
     parser_post_notifications.add_argument('run_dir')
     parser_post_notifications.set_defaults(func=post_validation_notifications_subcmd)
 
@@ -66,7 +415,74 @@ def parse_args(args):
     parser_find_resource.add_argument('run_dir')
     parser_find_resource.set_defaults(func=find_resource_by_id_subcmd)
 
-    return parser.parse_args(args)
+    parser_index = subparsers.add_parser('index')
+    parser_index.add_argument('--workers', type=int, default='1', help='Number of processes, 0 to use all cores')
+    parser_index.add_argument('run_dir')
+    parser_index.set_defaults(func=build_index_subcmd)
+
+    parser_export = subparsers.add_parser('export')
+    parser_export.add_argument('--workers', type=int, default='1', help='Number of processes, 0 to use all cores')
+    parser_export.add_argument('run_dir')
+    parser_export.set_defaults(func=export_run_subcmd)
+
+    parser_compare = subparsers.add_parser('compare')
+    parser_compare.add_argument('--workers', type=int, default='1', help='Number of processes per run, 0 to use all cores')
+    parser_compare.add_argument('--num-top', type=int, default='10', help='Number of templates and codings to list per change')
+    parser_compare.add_argument('--tmp-dir', help='Where to put the sorted copies of both runs, defaults to the system temp dir')
+    parser_compare.add_argument('run_dir_a')
+    parser_compare.add_argument('run_dir_b')
+    parser_compare.set_defaults(func=compare_subcmd)
+
+    parser_merge = subparsers.add_parser('merge')
+    parser_merge.add_argument('--num-top-errors', type=int, default='10')
+    parser_merge.add_argument('--max-error-keys', type=int, default=MAX_ERROR_KEYS, help='Distinct errors or templates to keep counts for, 0 for no limit')
+    parser_merge.add_argument('run_dir')
+    parser_merge.set_defaults(func=merge_shards_subcmd)
+
+    parser_unmapped_terms = subparsers.add_parser('unmapped-terms')
+    parser_unmapped_terms.add_argument('--workers', type=int, default='1', help='Number of processes, 0 to use all cores')
+    parser_unmapped_terms.add_argument('--no-cache', action='store_true', help='Re-read every file, ignoring cached results')
+    parser_unmapped_terms.add_argument('--top', type=int, default='50', help='Number of terms to print, 0 for all')
+    parser_unmapped_terms.add_argument('--output', help='Write all deduplicated terms as JSON to this file')
+    parser_unmapped_terms.add_argument('--post', action='store_true', help='Post one notification per deduplicated term to a single request and segment')
+    parser_unmapped_terms.add_argument('--tracking-service-base-url', default='http://localhost:8081')
+    parser_unmapped_terms.add_argument('--client-id')
+    parser_unmapped_terms.add_argument('--notifications-per-request', type=int, default='1000')
+    parser_unmapped_terms.add_argument('--max-retries', type=int, default='5')
+    parser_unmapped_terms.add_argument('run_dir')
+    parser_unmapped_terms.set_defaults(func=unmapped_terms_subcmd)
+
+    parsed = parser.parse_args(args)
+    if getattr(parsed, 'func', None) is run_subcmd and parsed.shard and not parsed.run_id:
+        parser.error('--shard needs --run-id, so that all shards write to the same run dir')
+    if getattr(parsed, 'func', None) is unmapped_terms_subcmd and parsed.post and not parsed.client_id:
+        parser.error('--post needs --client-id')
+    return parsed
+
+
+def add_run_options(parser):
+    parser.add_argument('--concurrency', type=int, default='8')
+    parser.add_argument('--rate-limit', type=float, default='0', help='Max Airflow API requests per second, 0 for no limit')
+    parser.add_argument('--max-retries', type=int, default='5')
+    parser.add_argument('--max-in-flight', type=int, default='0', help='Max unfinished DAG runs at any time, 0 to submit all files up front')
+    parser.add_argument('--live-analysis', action='store_true', help='Analyze validated output as soon as each DAG run succeeds')
+    parser.add_argument('--analysis-workers', type=int, default='1', help='Number of analysis processes, 0 to use all cores')
+    parser.add_argument('--error-templates', action='store_true', help='Group errors in the analysis by message template')
+    parser.add_argument('--examples-per-template', type=int, default='0', help='Raw messages to keep for each error template')
+    parser.add_argument('--max-error-keys', type=int, default=MAX_ERROR_KEYS, help='Distinct errors or templates to keep counts for, 0 for no limit')
+    parser.add_argument('--batch-mb', type=float, help='Trigger one DAG run per batch of input files of about this many MB, with file_names in the conf')
+    parser.add_argument('--max-files-per-batch', type=int, help='Max input files per batched DAG run')
+    parser.add_argument('--shard', type=shard_spec, help='Only handle the input files in shard i of N (i/N, 0 based), see merge')
+
+
+def positive_int(s: str) -> int:
+    try:
+        n = int(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected a number, got {s}")
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"Must be at least 1, got {s}")
+    return n
 
 
 def pipe_separated(s: str) -> typing.List[str]:
@@ -83,80 +499,417 @@ def trigger_dag_api(dag_id, conf=None, dag_run_id=None):
         payload['dag_run_id'] = dag_run_id
     if conf:
         payload['conf'] = conf
-    r = requests.post(url=url, json=payload, auth=(AIRFLOW_USER, AIRFLOW_PASSWORD))
-    if r.status_code / 100 != 2:
+    r = airflow_client().request('POST', url, metric='airflow.trigger_dag', json=payload)
+    if r.status_code == 409 and dag_run_id:
+        raise DagRunExists(f"Dag run {dag_run_id} already exists", retried=r.attempts > 1)
+    if r.status_code // 100 != 2:
         raise ApiException(f"Non-success status code from Airflow API {r.status_code}")
     return r.json()
 
 
 def get_dag_run_api(dag_id, dag_run_id):
     url = f"{AIRFLOW_API_BASE_URL}/dags/{dag_id}/dagRuns/{dag_run_id}"
-    r = requests.get(url, auth=(AIRFLOW_USER, AIRFLOW_PASSWORD))
-    if r.status_code / 100 != 2:
+    r = airflow_client().request('GET', url, metric='airflow.get_dag_run')
+    if r.status_code // 100 != 2:
         raise ApiException(f"Non-success status code from Airflow API {r.status_code}")
     return r.json()
 
 
-def trigger_dag(dag_id, file_name, workspace_dir, parent_run_id):
-    conf = {'workspace_dir': workspace_dir, 'file_name': file_name, 'parent_run_id': parent_run_id}
-    return trigger_dag_api(dag_id, conf=conf)
+def list_dag_runs_api(dag_id, execution_date_gte=None, page_limit=DAG_RUNS_PAGE_LIMIT,
+                      on_total_entries=None) -> typing.Iterator[typing.Dict]:
+    # on_total_entries is called with the total number of matching runs reported by each page
+    url = f"{AIRFLOW_API_BASE_URL}/dags/{dag_id}/dagRuns"
+    offset = 0
+    while True:
+        params = {'limit': page_limit, 'offset': offset}
+        if execution_date_gte:
+            params['execution_date_gte'] = execution_date_gte
+        r = airflow_client().request('GET', url, metric='airflow.list_dag_runs', params=params)
+        if r.status_code // 100 != 2:
+            raise ApiException(f"Non-success status code from Airflow API {r.status_code}")
+        body = r.json()
+        dag_runs = body.get('dag_runs', [])
+        if on_total_entries:
+            on_total_entries(body.get('total_entries', 0))
+        yield from dag_runs
+        offset += len(dag_runs)
+        if not dag_runs or offset >= body.get('total_entries', 0):
+            break
 
 
-def make_dirs(workspace_dir, run_id):
-    os.mkdir(os.path.join(workspace_dir, run_id))
+def trigger_dag(dag_id, file_name, workspace_dir, parent_run_id):
+    # A list of file names triggers one run for the whole batch, with file_names instead of file_name in the conf.
+    # The dag_run_id is derived from the file names, so when a POST that timed out or got a 5xx did create the run,
+    # the retry gets a 409 and the existing run is used instead of a duplicate. The same goes for a run created
+    # just before the process was killed, unless it failed. Failed runs, and runs of other files under the same id,
+    # are kept and the next one gets a numbered id.
+    conf = {'workspace_dir': workspace_dir}
+    if isinstance(file_name, list):
+        conf['file_names'] = file_name
+    else:
+        conf['file_name'] = file_name
+    conf['parent_run_id'] = parent_run_id
+    base_run_id = dag_run_id = dag_run_id_for(file_name, parent_run_id)
+    for attempt in itertools.count(2):
+        try:
+            return trigger_dag_api(dag_id, conf=conf, dag_run_id=dag_run_id)
+        except DagRunExists as e:
+            dag = get_dag_run_api(dag_id, dag_run_id)
+            if conf_file_names(dag.get('conf') or {}) == conf_file_names(conf) and \
+                    (e.retried or dag['state'] != 'failed'):
+                return dag
+        dag_run_id = f"{base_run_id}__{attempt}"
+
+
+def dag_run_id_for(file_name, parent_run_id) -> str:
+    # A batch is named after its first file and a crc32 of all its files, since resume can re-pack the same first
+    # file with others. Ids that had to be cleaned up get a crc32 of the original too, so p 1.csv and p_1.csv differ.
+    if isinstance(file_name, list):
+        names = '\n'.join(sorted(file_name)).encode('utf-8')
+        run_id = f"{parent_run_id}__batch__{os.path.basename(file_name[0])}__{zlib.crc32(names):08x}"
+    else:
+        run_id = f"{parent_run_id}__{os.path.basename(file_name)}"
+    safe_run_id = re.sub(r'[^A-Za-z0-9_.~:+-]', '_', run_id)
+    if safe_run_id != run_id:
+        safe_run_id += f"__{zlib.crc32(run_id.encode('utf-8')):08x}"
+    return safe_run_id
+
+
+def conf_file_names(conf: typing.Dict) -> typing.List[str]:
+    if conf.get('file_names'):
+        return conf['file_names']
+    return [conf['file_name']] if conf.get('file_name') else []
+
+
+def make_batches(file_names: typing.List[str], batch_mb=0.0, max_files_per_batch=0) -> typing.List[typing.List[str]]:
+    # Packs files into the fewest batches that stay around batch_mb and under max_files_per_batch. Largest files go
+    # first, each to the batch with the fewest bytes so far, so batch sizes end up within about one file of each other
+    sizes = {f: os.path.getsize(f) if os.path.exists(f) else 0 for f in file_names}
+    num_batches = 1
+    if batch_mb > 0:
+        num_batches = max(num_batches, -(-sum(sizes.values()) // max(int(batch_mb * 1024 * 1024), 1)))
+    if max_files_per_batch > 0:
+        num_batches = max(num_batches, -(-len(file_names) // max_files_per_batch))
+    num_batches = min(num_batches, len(file_names))
+    heap = [(0, i, []) for i in range(num_batches)]
+    full = []
+    for f in sorted(file_names, key=lambda f: (-sizes[f], f)):
+        size, i, batch = heapq.heappop(heap)
+        while max_files_per_batch > 0 and len(batch) >= max_files_per_batch:
+            full.append((size, i, batch))
+            size, i, batch = heapq.heappop(heap)
+        batch.append(f)
+        heapq.heappush(heap, (size + sizes[f], i, batch))
+    return sorted(sorted(batch) for _, _, batch in heap + full if batch)
+
+
+def trigger_dags(dag_id, files: typing.List[str], workspace_dir, parent_run_id, concurrency=1,
+                 on_triggered=None) -> typing.Dict:
+    dag_runs = {}
+    failed = 0
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        futures = {executor.submit(trigger_dag, dag_id, f, workspace_dir, parent_run_id): f for f in files}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                dag = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"WARN: Failed to trigger DAG for file {futures[future]}, error = {e}")
+                continue
+            dag_runs[dag['dag_run_id']] = dag
+            if on_triggered:
+                on_triggered(futures[future], dag)
+    time_taken = time.time() - start
+    rate = len(dag_runs) / time_taken if time_taken > 0 else 0.0
+    print(f"INFO: Triggered {len(dag_runs)} dag runs in {time_taken:.2f} seconds ({rate:.1f} runs/s), {failed} failed")
+    return dag_runs
+
+
+def make_dirs(workspace_dir, run_id, exist_ok=False):
+    os.makedirs(os.path.join(workspace_dir, run_id), exist_ok=exist_ok)
     for d in ('standardized', 'assigned', 'validated', 'term_notifications'):
-        os.mkdir(os.path.join(workspace_dir, run_id, d))
+        os.makedirs(os.path.join(workspace_dir, run_id, d), exist_ok=exist_ok)
+
+
+def shard_spec(s: str) -> typing.Tuple[int, int]:
+    try:
+        index, count = (int(x) for x in s.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected i/N, got {s}")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Shard index must be in 0..{count - 1}, got {s}")
+    return index, count
+
+
+def in_shard(file_name, shard: typing.Tuple[int, int]) -> bool:
+    # crc32 of the base name gives every process and machine the same partition, unlike hash()
+    index, count = shard
+    return zlib.crc32(os.path.basename(file_name).encode('utf-8')) % count == index
+
+
+def shard_file_name(file_name, shard: typing.Optional[typing.Sequence[int]]) -> str:
+    # manifest.json of shard 1 of 4 is manifest.shard-1-of-4.json
+    if not shard:
+        return file_name
+    stem, ext = os.path.splitext(file_name)
+    return f"{stem}.shard-{shard[0]}-of-{shard[1]}{ext}"
+
+
+class _JsonStream:
+    def __init__(self, f, track_offsets=False):
+        self.f = f
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.track_offsets = track_offsets
+        self.byte_pos = 0
+        self.byte_mark = 0
+
+    def _read(self, size=JSON_READ_CHUNK_SIZE) -> bool:
+        if self.eof:
+            return False
+        if self.pos > JSON_READ_CHUNK_SIZE:
+            if self.track_offsets:
+                self.tell()
+                self.byte_mark -= self.pos
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        chunk = self.f.read(size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf += chunk
+        return True
+
+    def tell(self) -> int:
+        self.byte_pos += len(self.buf[self.byte_mark:self.pos].encode('utf-8'))
+        self.byte_mark = self.pos
+        return self.byte_pos
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\n\r':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._read():
+                return ''
+
+    def expect(self, ch: str):
+        if self.peek() != ch:
+            raise ValueError(f"Expected '{ch}' at position {self.pos} of {self.f.name}")
+        self.pos += 1
+
+    def decode(self):
+        self.peek()
+        while True:
+            try:
+                value, end = _JSON_DECODER.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                # Value runs past the end of the buffer, read more and retry (growing reads keep this linear)
+                if not self._read(max(JSON_READ_CHUNK_SIZE, len(self.buf) - self.pos)):
+                    raise
+                continue
+            # A number or literal at the very end of the buffer may continue in the next chunk
+            if end == len(self.buf) and self._read():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_json_array(file_name: str, key: str = None, with_offsets=False) -> typing.Iterator:
+    # Yields the elements of a top level JSON array (or of the array under `key` in a top level object,
+    # e.g. 'entry' of a Bundle) one at a time, so memory does not grow with the file size.
+    # With with_offsets, (byte offset, element) tuples are yielded instead.
+    # Read and decode time, not the caller's time between elements, is recorded as parse.<dir name> per file.
+    seconds = 0.0
+    failed = True
+    # newline='' keeps \r\n as two characters, otherwise byte offsets drift by one per line in CRLF files
+    with open(file_name, 'r', encoding='utf-8', newline='') as f:
+        elements = _iter_json_stream(_JsonStream(f, track_offsets=with_offsets), file_name, key, with_offsets)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    element = next(elements)
+                except StopIteration:
+                    failed = False
+                    return
+                finally:
+                    seconds += time.perf_counter() - start
+                yield element
+        except GeneratorExit:
+            failed = False
+            raise
+        finally:
+            elements.close()
+            kind = os.path.basename(os.path.dirname(os.path.abspath(file_name)))
+            metrics().observe('parse.' + kind, seconds, error=failed, bytes_received=f.buffer.tell())
+
+
+def _iter_json_stream(stream: _JsonStream, file_name: str, key: str, with_offsets: bool) -> typing.Iterator:
+    if key is not None:
+        stream.expect('{')
+        while True:
+            if stream.peek() == '}':
+                return
+            k = stream.decode()
+            stream.expect(':')
+            if k == key:
+                break
+            stream.decode()
+            if stream.peek() == ',':
+                stream.pos += 1
+    stream.expect('[')
+    if stream.peek() == ']':
+        return
+    while True:
+        if with_offsets:
+            stream.peek()
+            offset = stream.tell()
+            yield offset, stream.decode()
+        else:
+            yield stream.decode()
+        ch = stream.peek()
+        if ch == ',':
+            stream.pos += 1
+        elif ch == ']':
+            return
+        else:
+            raise ValueError(f"Expected ',' or ']' at position {stream.pos} of {file_name}")
+
+
+def read_json_at(file_name: str, offset: int):
+    with open(file_name, 'rb') as raw:
+        raw.seek(offset)
+        with io.TextIOWrapper(raw, encoding='utf-8', newline='') as f:
+            return _JsonStream(f).decode()
+
+
+# Parts of diagnostics that vary between otherwise identical messages, applied in order
+DIAGNOSTIC_PATTERNS = [
+    (re.compile(r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}'), '<uuid>'),
+    (re.compile(r'\d{4}-\d{2}-\d{2}(T[\d:.]+(Z|[+-]\d{2}:\d{2})?)?'), '<date>'),
+    (re.compile(r'(?<![\w/])([A-Z][A-Za-z]+)/[A-Za-z0-9\-.]{1,64}'), r'\1/<id>'),
+    (re.compile(r'#[A-Za-z0-9\-._]+'), '#<code>'),
+    (re.compile(r'\[\d+\]'), '[n]'),
+    (re.compile(r"'[^']*\d[^']*'"), "'<value>'"),
+    (re.compile(r'"[^"]*\d[^"]*"'), '"<value>"'),
+    (re.compile(r'(?<![\w<])-?\d+(\.\d+)?(?![\w>])'), '<n>'),
+]
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def normalize_diagnostic(diagnostics: str) -> str:
+    template = diagnostics
+    for pattern, replacement in DIAGNOSTIC_PATTERNS:
+        template = pattern.sub(replacement, template)
+    return sys.intern(template)
 
 
 def analyze_file(validation_file: str, params=None) -> typing.Dict:
-    with open(validation_file, 'r') as f:
-        data = json.load(f)
-        total_resources = 0
-        profile_assigned = 0
-        all_errors = collections.defaultdict(int)
-        gold = []
-        for r in data:
-            total_resources += 1
-            if 'profile' in r:
-                profile_assigned += 1
-                issues = r['validations']['issue']
-                errors = [i for i in issues if i['severity'] == 'error']
-                if len(errors) == 0:
-                    gold.append(r['id'])
-                for e in errors:
-                    k = e['diagnostics']
-                    all_errors[k] += 1
-
-        # top_errors = {}
-        # for e in sorted(all_errors, key=lambda k: all_errors[k], reverse=True)[:10]:
-        #     top_errors[e] = all_errors[e]
-
-        return {
-            'total': total_resources,
-            'profile_assigned': profile_assigned,
-            'gold': gold,
-            'top_errors': all_errors
-        }
+    params = params or {}
+    error_templates = params.get('error_templates', False)
+    examples_per_template = params.get('examples_per_template', 0)
+    total_resources = 0
+    profile_assigned = 0
+    all_errors = collections.defaultdict(int)
+    error_examples = collections.defaultdict(list)
+    gold = []
+    for r in iter_json_array(validation_file):
+        total_resources += 1
+        if 'profile' in r:
+            profile_assigned += 1
+            issues = r['validations']['issue']
+            errors = [i for i in issues if i['severity'] == 'error']
+            if len(errors) == 0:
+                gold.append(r['id'])
+            for e in errors:
+                k = e['diagnostics']
+                if error_templates:
+                    k = normalize_diagnostic(k)
+                    examples = error_examples[k]
+                    if len(examples) < examples_per_template and e['diagnostics'] not in examples:
+                        examples.append(e['diagnostics'])
+                all_errors[k] += 1
+
+    # top_errors = {}
+    # for e in sorted(all_errors, key=lambda k: all_errors[k], reverse=True)[:10]:
+    #     top_errors[e] = all_errors[e]
+
+    result = {
+        'total': total_resources,
+        'profile_assigned': profile_assigned,
+        'gold': gold,
+        'top_errors': all_errors
+    }
+    if examples_per_template:
+        result['error_examples'] = {k: v for k, v in error_examples.items() if v}
+    return result
 
 
-def summarize(analyses: typing.List[typing.Dict], num_top_errors: int):
-    total_resources = sum([a['total'] for a in analyses])
-    profile_assigned = sum([a['profile_assigned'] for a in analyses])
-    all_gold = []
-    for a in analyses:
-        all_gold.extend(a['gold'])
-    total_gold = len(all_gold)
+def empty_analysis(examples_per_template=0, max_error_keys=MAX_ERROR_KEYS) -> typing.Dict:
+    analysis = {
+        'total': 0,
+        'profile_assigned': 0,
+        'gold_count': 0,
+        'gold': [],
+        'top_errors': collections.defaultdict(int),
+        'max_error_keys': max_error_keys,
+        'other_errors': 0
+    }
+    if examples_per_template:
+        analysis['examples_per_template'] = examples_per_template
+        analysis['error_examples'] = collections.defaultdict(list)
+    return analysis
+
+
+def merge_analysis(merged: typing.Dict, a: typing.Dict) -> typing.Dict:
+    merged['total'] += a['total']
+    merged['profile_assigned'] += a['profile_assigned']
+    merged['gold_count'] += a.get('gold_count', len(a['gold']))
+    # Only a sample of gold ids is ever printed, don't hold on to all of them
+    if len(merged['gold']) < GOLD_SAMPLE_SIZE:
+        merged['gold'].extend(a['gold'][:GOLD_SAMPLE_SIZE - len(merged['gold'])])
+    top_errors = merged['top_errors']
+    for e, num in a['top_errors'].items():
+        top_errors[e] += num
+    merged['other_errors'] += a.get('other_errors', 0)
+    if 'error_examples' in merged:
+        max_examples = merged['examples_per_template']
+        for e, raw in a.get('error_examples', {}).items():
+            examples = merged['error_examples'][e]
+            examples.extend(m for m in raw[:max_examples - len(examples)] if m not in examples)
+    max_error_keys = merged.get('max_error_keys', 0)
+    if max_error_keys and len(top_errors) > 2 * max_error_keys:
+        _prune_top_errors(merged, max_error_keys)
+    return merged
+
+
+def _prune_top_errors(analysis: typing.Dict, max_error_keys: int):
+    # Keeps the most frequent keys once there are twice as many as allowed, the counts of the others are added to
+    # other_errors. A dropped key that comes back starts again from zero, so no count is off by more than that.
+    top_errors = analysis['top_errors']
+    kept = heapq.nlargest(max_error_keys, top_errors.items(), key=lambda kv: kv[1])
+    analysis['other_errors'] += sum(top_errors.values()) - sum(num for _, num in kept)
+    analysis['top_errors'] = collections.defaultdict(int, kept)
+    if 'error_examples' in analysis:
+        analysis['error_examples'] = collections.defaultdict(
+            list, {k: v for k, v in analysis['error_examples'].items() if k in analysis['top_errors']})
+
+
+def summarize(analysis: typing.Dict, num_top_errors: int):
+    total_resources = analysis['total']
+    profile_assigned = analysis['profile_assigned']
+    all_gold = analysis['gold']
+    total_gold = analysis['gold_count']
     if total_gold > 0:
         print("GOLD FOUND!!!")
     else:
         print("No gold found :-(")
 
-    top_errors = collections.defaultdict(int)
-    for a in analyses:
-        errs = a['top_errors']
-        for e, num in errs.items():
-            top_errors[e] += num
-
+    top_errors = analysis['top_errors']
     sorted_top_n = sorted(top_errors, key=lambda k: top_errors[k], reverse=True)[:num_top_errors]
 
     print(
@@ -166,16 +919,127 @@ def summarize(analyses: typing.List[typing.Dict], num_top_errors: int):
 
     print(f"Top {num_top_errors} errors")
     print("=============")
-    print("\n" + "\n".join([f"{top_errors[k]} {k}" for k in sorted_top_n]))
+    error_examples = analysis.get('error_examples', {})
+    lines = []
+    for k in sorted_top_n:
+        lines.append(f"{top_errors[k]} {k}")
+        lines.extend(f"    e.g. {m}" for m in error_examples.get(k, []))
+    if analysis.get('other_errors'):
+        lines.append(f"{analysis['other_errors']} errors with rarer messages, beyond --max-error-keys, not counted above")
+    print("\n" + "\n".join(lines))
+
+
+def parallel_map(fn, items: typing.List, workers: int) -> typing.Iterator:
+    # Results are yielded in the order of items, so reductions over them match the serial path.
+    # Metrics recorded in the worker processes are merged into this process's metrics.
+    if workers <= 1 or len(items) <= 1:
+        yield from map(fn, items)
+        return
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    try:
+        chunksize = max(1, len(items) // (workers * 4))
+        for result, snapshot in executor.map(functools.partial(_call_with_metrics, fn), items, chunksize=chunksize):
+            metrics().merge(snapshot)
+            yield result
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def num_workers(workers: int) -> int:
+    return workers if workers > 0 else (os.cpu_count() or 1)
+
+
+class ResultCache:
+    # Per-file partial results, valid as long as the file's size and mtime are unchanged
+    def __init__(self, cache_file):
+        self.conn = sqlite3.connect(cache_file)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS results (kind TEXT NOT NULL, path TEXT NOT NULL, '
+                          'size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, result TEXT NOT NULL, '
+                          'PRIMARY KEY (kind, path))')
+
+    def keys(self, kind: str) -> typing.Dict[str, typing.Tuple[int, int]]:
+        rows = self.conn.execute('SELECT path, size, mtime_ns FROM results WHERE kind = ?', (kind,))
+        return {path: (size, mtime_ns) for path, size, mtime_ns in rows}
+
+    def get(self, kind: str, path: str):
+        row = self.conn.execute('SELECT result FROM results WHERE kind = ? AND path = ?', (kind, path)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, kind: str, path: str, size: int, mtime_ns: int, result):
+        self.conn.execute('INSERT OR REPLACE INTO results (kind, path, size, mtime_ns, result) VALUES (?, ?, ?, ?, ?)',
+                          (kind, path, size, mtime_ns, json.dumps(result)))
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+def open_cache(run_dir) -> typing.Optional[ResultCache]:
+    try:
+        return ResultCache(os.path.join(run_dir, CACHE_FILE_NAME))
+    except sqlite3.Error as e:
+        print(f"WARN: Could not open analysis cache in {run_dir}, error = {e}")
+        return None
+
+
+def cached_map(fn, kind: str, file_names: typing.List[str], workers: int,
+               cache: typing.Optional[ResultCache]) -> typing.Iterator:
+    # Like parallel_map, but only files that are new or changed since they were last cached are processed
+    if cache is None:
+        yield from parallel_map(fn, file_names, workers)
+        return
+    try:
+        cached_keys = cache.keys(kind)
+        stats = {f: os.stat(f) for f in file_names}
+        fresh = {f for f in file_names if cached_keys.get(os.path.abspath(f)) == (stats[f].st_size, stats[f].st_mtime_ns)}
+        computed = parallel_map(fn, [f for f in file_names if f not in fresh], workers)
+        for f in file_names:
+            if f in fresh:
+                yield cache.get(kind, os.path.abspath(f))
+            else:
+                result = next(computed)
+                cache.put(kind, os.path.abspath(f), stats[f].st_size, stats[f].st_mtime_ns, result)
+                yield result
+    finally:
+        cache.close()
 
 
 def main(args):
     args = parse_args(args)
-    args.func(args)
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    try:
+        args.func(args)
+    finally:
+        if profiler:
+            profiler.disable()
+            write_profile(profiler, args.profile)
+        write_metrics(args.metrics_file, args.prometheus_file)
+
+
+def write_profile(profiler: cProfile.Profile, profile_file):
+    profiler.dump_stats(profile_file)
+    with open(profile_file + '.txt', 'w') as f:
+        stats = pstats.Stats(profiler, stream=f)
+        stats.sort_stats('cumulative').print_stats(50)
+        stats.sort_stats('tottime').print_stats(50)
+    print(f"INFO: Wrote profile to {profile_file}, top functions in {profile_file}.txt")
+
+
+def write_metrics(metrics_file, prometheus_file):
+    if metrics_file:
+        metrics().write_json(metrics_file)
+        print(f"INFO: Wrote metrics to {metrics_file}")
+    if prometheus_file:
+        metrics().write_prometheus(prometheus_file)
+        print(f"INFO: Wrote Prometheus metrics to {prometheus_file}")
 
 
 def analyze_subcmd(args):
-    analyze(args.validation_dir, args.num_top_errors)
+    analyze(args.validation_dir, args.num_top_errors, args.workers, use_cache=not args.no_cache,
+            error_templates=args.error_templates, examples_per_template=args.examples_per_template,
+            from_export=args.from_export, max_error_keys=args.max_error_keys)
 
 
 def run_subcmd(args):
@@ -191,127 +1055,611 @@ def run_subcmd(args):
         sorted_files = sorted(os.listdir(args.input_dir))
     if args.limit > 0:
         sorted_files = sorted_files[:args.limit]
-    run_id = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
-    if args.run_id_prefix:
-        run_id = args.run_id_prefix + '-' + run_id
-    make_dirs(args.workspace_dir, run_id)
-    dag_runs = {}
-    for f in sorted_files:
-        file_name = os.path.join(args.input_dir, f)
-        dag = trigger_dag(args.dag_id, file_name, args.workspace_dir, run_id)
-        dag_runs[dag['dag_run_id']] = dag
+    if args.shard:
+        sorted_files = [f for f in sorted_files if in_shard(f, args.shard)]
+        print(f"INFO: Shard {args.shard[0]} of {args.shard[1]} has {len(sorted_files)} files")
+    if args.run_id:
+        run_id = args.run_id
+    else:
+        run_id = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        if args.run_id_prefix:
+            run_id = args.run_id_prefix + '-' + run_id
+    # Shards of one run share the run dir, each one creates it if it's the first
+    make_dirs(args.workspace_dir, run_id, exist_ok=bool(args.shard))
+    file_names = [os.path.join(args.input_dir, f) for f in sorted_files]
+    run = {'dag_id': args.dag_id, 'workspace_dir': args.workspace_dir, 'run_id': run_id,
+           'batch_mb': args.batch_mb or 0, 'max_files_per_batch': args.max_files_per_batch or 0}
+    if args.shard:
+        run['shard'] = list(args.shard)
+    manifest_file = shard_file_name(MANIFEST_FILE_NAME, args.shard)
+    manifest = RunManifest(os.path.join(args.workspace_dir, run_id, manifest_file), run, file_names)
+    manifest.save(force=True)
+    execute_run(args, os.path.join(args.workspace_dir, run_id), manifest, file_names, {})
+
+
+def resume_subcmd(args):
+    manifest = RunManifest.load(os.path.join(args.run_dir, shard_file_name(MANIFEST_FILE_NAME, args.shard)))
+    dag_runs = manifest.unfinished_dag_runs()
+    file_names = manifest.files_to_trigger()
+    print(f"INFO: Resuming run {manifest.run['run_id']}, polling {len(dag_runs)} unfinished dag runs "
+          f"and triggering {len(file_names)} failed or never submitted files")
+    execute_run(args, args.run_dir, manifest, file_names, dag_runs)
+
+
+def execute_run(args, run_dir, manifest: 'RunManifest', file_names: typing.List[str], dag_runs: typing.Dict):
+    dag_id = manifest.run['dag_id']
+    workspace_dir = manifest.run['workspace_dir']
+    run_id = manifest.run['run_id']
+    configure_airflow_client(pool_size=args.concurrency, rate_limit=args.rate_limit, max_retries=args.max_retries)
+    validation_dir = os.path.join(run_dir, 'validated')
+    shard = manifest.run.get('shard')
+    # A shard only analyzes the output of its own files, other shards may still be writing theirs
+    stems = {os.path.splitext(os.path.basename(f))[0] for f in manifest.files} if shard else None
+    examples_per_template = args.examples_per_template if args.error_templates else 0
+    params = {'error_templates': args.error_templates, 'examples_per_template': examples_per_template}
+    live_analyzer = LiveAnalyzer(validation_dir, num_workers(args.analysis_workers), stems=stems, params=params,
+                                 max_error_keys=args.max_error_keys) if args.live_analysis else None
+
+    def on_progress(changed):
+        manifest.update(changed)
+        if live_analyzer:
+            live_analyzer.on_progress(changed)
+
+    # Resume packs the remaining files the same way as the original run, unless told otherwise
+    batch_mb = args.batch_mb if args.batch_mb is not None else manifest.run.get('batch_mb', 0)
+    max_files_per_batch = args.max_files_per_batch if args.max_files_per_batch is not None else \
+        manifest.run.get('max_files_per_batch', 0)
+    to_trigger = file_names
+    if batch_mb > 0 or max_files_per_batch > 0:
+        to_trigger = make_batches(file_names, batch_mb, max_files_per_batch)
+        print(f"INFO: Packed {len(file_names)} files into {len(to_trigger)} batches")
 
     start = time.time()
-    wait_for_completion(args.dag_id, dag_runs)
+    if args.max_in_flight > 0:
+        run_windowed(dag_id, to_trigger, workspace_dir, run_id, args.max_in_flight, args.concurrency,
+                     on_progress=on_progress, on_triggered=manifest.submitted, dag_runs=dag_runs)
+    else:
+        triggered = trigger_dags(dag_id, to_trigger, workspace_dir, run_id, args.concurrency,
+                                 on_triggered=manifest.submitted)
+        manifest.save(force=True)
+        wait_for_completion(dag_id, {**dag_runs, **triggered}, on_progress=on_progress)
+    manifest.save(force=True)
     end = time.time()
     time_taken = end - start
     print(f"INFO: Completed all dag runs in {time_taken:.2f} seconds!!!")
 
-    validation_dir = os.path.join(args.workspace_dir, run_id, 'validated')
-    analyze(validation_dir, 10)
-
-def wait_for_completion(dag_id, dag_runs):
-    while not all_dag_runs_completed(dag_runs):
-        new_dag_runs = {}
-        for run_id, dag in dag_runs.items():
-            try:
-                if dag['state'] not in ('success', 'failed'):
-                    d = get_dag_run_api(dag_id, run_id)
-                    new_dag_runs[run_id] = d
-                else:
-                    new_dag_runs[run_id] = dag
-            except Exception as e:
-                new_dag_runs[run_id] = dag
-                print(f"WARN: Failed to get DAG run for id {run_id}, error = {e}")
-        dag_runs = new_dag_runs
-        print_stats(dag_runs)
-        time.sleep(2)
-
-def print_stats(dag_runs: typing.Dict):
-    stats = collections.defaultdict(int)
-    for v in dag_runs.values():
-        stats[v['state']] += 1
-
+    if live_analyzer:
+        analysis = live_analyzer.finish()
+        summarize(analysis, 10)
+    else:
+        # Shards don't share the analysis cache, its SQLite file would be written by several processes at once
+        analysis = analyze(validation_dir, 10, args.analysis_workers, use_cache=not shard,
+                           error_templates=args.error_templates, examples_per_template=examples_per_template,
+                           stems=stems, max_error_keys=args.max_error_keys)
+    if shard:
+        analysis_file = os.path.join(run_dir, shard_file_name(ANALYSIS_FILE_NAME, shard))
+        _write_atomic(analysis_file, json.dumps(analysis))
+        print(f"INFO: Wrote analysis of shard {shard[0]} of {shard[1]} to {analysis_file}, "
+              f"run merge once all shards are done")
+
+
+def merge_shards_subcmd(args):
+    merge_shards(args.run_dir, args.num_top_errors, args.max_error_keys)
+
+
+def merge_shards(run_dir, num_top_errors, max_error_keys=MAX_ERROR_KEYS) -> typing.Dict:
+    # Combines the manifests and analyses of all shards of a run into manifest.json and analysis.json, so the whole
+    # cohort can be resumed from one place, and prints the same summary a single run would
+    shard_re = re.compile(r'manifest\.shard-(\d+)-of-(\d+)\.json')
+    shards = sorted((int(m.group(1)), int(m.group(2))) for m in map(shard_re.fullmatch, os.listdir(run_dir)) if m)
+    if not shards:
+        print(f"WARN: No shard manifests found in {run_dir}")
+        return {}
+    counts = {count for _, count in shards}
+    if len(counts) > 1:
+        print(f"WARN: Shard manifests of different shard counts {sorted(counts)} found, merging all of them")
+    missing = [i for count in counts for i in range(count) if (i, count) not in shards]
+    if missing:
+        print(f"WARN: Missing manifests of shards {missing}, their files are not included")
+
+    run = None
+    files = {}
+    analysis = empty_analysis(max_error_keys=max_error_keys)
+    for shard in shards:
+        manifest = RunManifest.load(os.path.join(run_dir, shard_file_name(MANIFEST_FILE_NAME, shard)))
+        run = run or {k: v for k, v in manifest.run.items() if k != 'shard'}
+        files.update(manifest.files)
+        analysis_file = os.path.join(run_dir, shard_file_name(ANALYSIS_FILE_NAME, shard))
+        if not os.path.exists(analysis_file):
+            print(f"WARN: Shard {shard[0]} of {shard[1]} has no analysis yet, is it still running?")
+            continue
+        with open(analysis_file, 'r') as f:
+            shard_analysis = json.load(f)
+        # Shards run with --examples-per-template keep their examples in the merged analysis
+        if shard_analysis.get('examples_per_template') and 'error_examples' not in analysis:
+            analysis['examples_per_template'] = shard_analysis['examples_per_template']
+            analysis['error_examples'] = collections.defaultdict(list)
+        merge_analysis(analysis, shard_analysis)
+
+    RunManifest(os.path.join(run_dir, MANIFEST_FILE_NAME), run, [], files).save(force=True)
+    _write_atomic(os.path.join(run_dir, ANALYSIS_FILE_NAME), json.dumps(analysis))
+    states = collections.Counter(v['state'] or 'not_submitted' for v in files.values())
+    print(f"INFO: Merged {len(shards)} shards with {len(files)} files")
+    print()
+    print("Files")
+    print("=====")
+    for k, v in states.items():
+        print(f"{k} {v}")
+    print()
+    summarize(analysis, num_top_errors)
+    return analysis
+
+
+class RunManifest:
+    # Maps every input file of a run to its dag run id and last known state, so a killed run can be resumed.
+    # With batching several files share a dag run id.
+    def __init__(self, manifest_file, run: typing.Dict, file_names: typing.List[str], files: typing.Dict = None):
+        self.manifest_file = manifest_file
+        self.run = run
+        self.files = files if files is not None else \
+            {f: {'dag_run_id': None, 'state': None, 'execution_date': None} for f in file_names}
+        self.run_files = collections.defaultdict(list)
+        for f, v in self.files.items():
+            if v['dag_run_id']:
+                self.run_files[v['dag_run_id']].append(f)
+        self.last_saved = 0.0
+        self.unsaved_submissions = False
+
+    @classmethod
+    def load(cls, manifest_file) -> 'RunManifest':
+        with open(manifest_file, 'r') as f:
+            data = json.load(f)
+        return cls(manifest_file, data['run'], [], data['files'])
+
+    def submitted(self, file_name, dag_run: typing.Dict):
+        # file_name is a list for a batch
+        for f in file_name if isinstance(file_name, list) else [file_name]:
+            old_run_id = self.files[f]['dag_run_id']
+            if old_run_id:
+                self.run_files.pop(old_run_id, None)
+            self.files[f] = {'dag_run_id': dag_run['dag_run_id'], 'state': dag_run['state'],
+                             'execution_date': dag_run.get('execution_date')}
+            self.run_files[dag_run['dag_run_id']].append(f)
+        self.unsaved_submissions = True
+        self.save()
+
+    def update(self, dag_runs: typing.List[typing.Dict]):
+        for run in dag_runs:
+            for f in self.run_files.get(run['dag_run_id'], ()):
+                self.files[f]['state'] = run['state']
+        # A lost run id means the file is triggered twice on resume, so new submissions are saved every poll cycle
+        self.save(force=self.unsaved_submissions)
+
+    def unfinished_dag_runs(self) -> typing.Dict:
+        dag_runs = {}
+        for f, v in self.files.items():
+            if v['dag_run_id'] and v['state'] not in TERMINAL_STATES:
+                run = dag_runs.setdefault(v['dag_run_id'], {'dag_run_id': v['dag_run_id'],
+                                                            'state': v['state'] or 'queued',
+                                                            'execution_date': v['execution_date'], 'conf': {}})
+                run['conf'].setdefault('file_names', []).append(f)
+        for run in dag_runs.values():
+            if len(run['conf']['file_names']) == 1:
+                run['conf'] = {'file_name': run['conf']['file_names'][0]}
+        return dag_runs
+
+    def files_to_trigger(self) -> typing.List[str]:
+        return [f for f, v in self.files.items() if not v['dag_run_id'] or v['state'] == 'failed']
+
+    def save(self, force=False):
+        # Rewriting the whole manifest is cheap next to a poll cycle, but don't do it more than every few seconds
+        interval = MANIFEST_SUBMISSIONS_SAVE_INTERVAL if self.unsaved_submissions else MANIFEST_SAVE_INTERVAL
+        if not force and time.monotonic() - self.last_saved < interval:
+            return
+        tmp_file = self.manifest_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'run': self.run, 'files': self.files}, f)
+        os.replace(tmp_file, self.manifest_file)
+        self.last_saved = time.monotonic()
+        self.unsaved_submissions = False
+
+
+def run_windowed(dag_id, files: typing.List[str], workspace_dir, parent_run_id, max_in_flight: int,
+                 concurrency=1, on_progress=None, on_triggered=None, dag_runs=None) -> typing.Dict:
+    # Keep at most max_in_flight runs unfinished; a new file is only triggered once an earlier run completes
+    not_submitted = collections.deque(files)
+    files_not_submitted = sum(len(f) if isinstance(f, list) else 1 for f in files)
+    tracker = DagRunTracker(dag_runs)
+    failed_to_trigger = 0
+    interval = MIN_POLL_INTERVAL
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        while not_submitted or tracker.unfinished:
+            batch = []
+            while not_submitted and len(tracker.unfinished) + len(batch) < max_in_flight:
+                batch.append(not_submitted.popleft())
+                files_not_submitted -= len(batch[-1]) if isinstance(batch[-1], list) else 1
+            futures = {executor.submit(trigger_dag, dag_id, f, workspace_dir, parent_run_id): f for f in batch}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    dag = future.result()
+                except Exception as e:
+                    failed_to_trigger += len(futures[future]) if isinstance(futures[future], list) else 1
+                    print(f"WARN: Failed to trigger DAG for file {futures[future]}, error = {e}")
+                    continue
+                tracker.update(dag)
+                if on_triggered:
+                    on_triggered(futures[future], dag)
+
+            changed = poll_dag_runs(dag_id, tracker, executor)
+            print_stats(tracker, not_submitted=len(not_submitted), files_not_submitted=files_not_submitted)
+            if on_progress:
+                on_progress(changed)
+            # Back off while no run finishes, but never poll again without waiting at least MIN_POLL_INTERVAL
+            if any(r['state'] in TERMINAL_STATES for r in changed):
+                interval = MIN_POLL_INTERVAL
+            if tracker.unfinished:
+                time.sleep(interval)
+                interval = min(interval * POLL_BACKOFF_FACTOR, MAX_POLL_INTERVAL)
+    if failed_to_trigger:
+        print(f"WARN: {failed_to_trigger} files could not be triggered")
+    return tracker.dag_runs
+
+
+def wait_for_completion(dag_id, dag_runs, on_progress=None) -> typing.Dict:
+    tracker = DagRunTracker(dag_runs)
+    interval = MIN_POLL_INTERVAL
+    with concurrent.futures.ThreadPoolExecutor(max_workers=POLL_CONCURRENCY) as executor:
+        while not all_dag_runs_completed(tracker):
+            changed = poll_dag_runs(dag_id, tracker, executor)
+            print_stats(tracker)
+            if on_progress:
+                on_progress(changed)
+            if all_dag_runs_completed(tracker):
+                break
+            # Back off while nothing changes, go back to fast polling as soon as runs move
+            interval = MIN_POLL_INTERVAL if changed else min(interval * POLL_BACKOFF_FACTOR, MAX_POLL_INTERVAL)
+            time.sleep(interval)
+    return tracker.dag_runs
+
+
+def poll_dag_runs(dag_id, tracker: 'DagRunTracker', executor=None) -> typing.List[typing.Dict]:
+    if not tracker.unfinished:
+        return []
+    # One paged list query costs ceil(n / page size) requests, fetch individually when fewer runs are left. The list
+    # also returns runs of other parent runs and shards since min_execution_date, so n is the total_entries of the
+    # last list, or at least the runs tracked here.
+    listed = max(tracker.total_entries or 0, len(tracker.dag_runs))
+    pages = -(-listed // DAG_RUNS_PAGE_LIMIT)
+    changed = []
+    if len(tracker.unfinished) > pages:
+        try:
+            for run in list_dag_runs_api(dag_id, execution_date_gte=tracker.min_execution_date,
+                                         on_total_entries=functools.partial(setattr, tracker, 'total_entries')):
+                if run['dag_run_id'] in tracker.unfinished and tracker.update(run):
+                    changed.append(run)
+            return changed
+        except Exception as e:
+            print(f"WARN: Failed to list DAG runs for dag {dag_id}, error = {e}")
+
+    run_ids = list(tracker.unfinished)
+    results = executor.map(_get_dag_run_or_none, [dag_id] * len(run_ids), run_ids) if executor else \
+        (_get_dag_run_or_none(dag_id, run_id) for run_id in run_ids)
+    for run in results:
+        if run is not None and tracker.update(run):
+            changed.append(run)
+    return changed
+
+
+def _get_dag_run_or_none(dag_id, run_id):
+    try:
+        return get_dag_run_api(dag_id, run_id)
+    except Exception as e:
+        print(f"WARN: Failed to get DAG run for id {run_id}, error = {e}")
+        return None
+
+
+class DagRunTracker:
+    def __init__(self, dag_runs: typing.Optional[typing.Dict] = None):
+        self.dag_runs = {}
+        self.stats = collections.Counter()
+        # Input files by state of their dag run, differs from stats when runs are batched
+        self.file_stats = collections.Counter()
+        self.num_files = {}
+        self.unfinished = set()
+        self.min_execution_date = None
+        # Runs matched by the last list query, None until the first one
+        self.total_entries = None
+        for run in (dag_runs or {}).values():
+            self.update(run)
+
+    def update(self, run: typing.Dict) -> bool:
+        run_id = run['dag_run_id']
+        old = self.dag_runs.get(run_id)
+        self.dag_runs[run_id] = run
+        num_files = self.num_files.setdefault(run_id, max(len(conf_file_names(run.get('conf') or {})), 1))
+        if old is not None:
+            if old['state'] == run['state']:
+                return False
+            for stats, n in ((self.stats, 1), (self.file_stats, num_files)):
+                stats[old['state']] -= n
+                if not stats[old['state']]:
+                    del stats[old['state']]
+        self.stats[run['state']] += 1
+        self.file_stats[run['state']] += num_files
+        if run['state'] in TERMINAL_STATES:
+            self.unfinished.discard(run_id)
+        else:
+            self.unfinished.add(run_id)
+        execution_date = run.get('execution_date')
+        if execution_date and (self.min_execution_date is None or execution_date < self.min_execution_date):
+            self.min_execution_date = execution_date
+        return True
+
+
+def print_stats(tracker: DagRunTracker, not_submitted=0, files_not_submitted=0):
     print()
     print("Progress")
     print("========")
-    for k, v in stats.items():
+    for k, v in tracker.stats.items():
         print(f"{k} {v}")
+    if not_submitted:
+        print(f"not_submitted {not_submitted}")
+    if tracker.file_stats != tracker.stats:
+        print()
+        print("Files")
+        print("=====")
+        for k, v in tracker.file_stats.items():
+            print(f"{k} {v}")
+        if files_not_submitted:
+            print(f"not_submitted {files_not_submitted}")
     print()
 
 
-def all_dag_runs_completed(dag_runs) -> bool:
-    return all([v['state'] in ('success', 'failed') for k, v in dag_runs.items()])
-
-
-def analyze(validation_dir, num_top_errors):
-    analyses = []
-    for f in os.listdir(validation_dir):
-        file_name = str(os.path.join(validation_dir, f))
-        a = analyze_file(file_name)
-        analyses.append(a)
-
-    summarize(analyses, num_top_errors)
+def all_dag_runs_completed(tracker: DagRunTracker) -> bool:
+    return not tracker.unfinished
+
+
+class LiveAnalyzer:
+    # Analyzes the validated output of each DAG run as soon as it succeeds, while other runs are still going.
+    # Output files are matched to runs by the input file name without extension; anything not matched that way
+    # is picked up by finish() once all runs are done.
+    def __init__(self, validation_dir, workers=1, num_top_errors=5, stems=None, params=None,
+                 max_error_keys=MAX_ERROR_KEYS):
+        self.validation_dir = validation_dir
+        self.num_top_errors = num_top_errors
+        self.stems = stems
+        self.params = params or {}
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        self.submitted = set()
+        self.futures = {}
+        self.analysis = empty_analysis(self.params.get('examples_per_template', 0), max_error_keys)
+        self.files_analyzed = 0
+
+    def on_progress(self, changed_runs: typing.List[typing.Dict]):
+        stems = set()
+        for run in changed_runs:
+            if run['state'] == 'success':
+                for file_name in conf_file_names(run.get('conf') or {}):
+                    stems.add(os.path.splitext(os.path.basename(file_name))[0])
+        if stems:
+            for f in os.listdir(self.validation_dir):
+                if os.path.splitext(f)[0] in stems:
+                    self._submit(f)
+        if self._collect():
+            self.print_summary()
+
+    def finish(self) -> typing.Dict:
+        # Files that failed while runs were in progress are retried once here
+        concurrent.futures.wait(self.futures)
+        self._collect()
+        for f in os.listdir(self.validation_dir):
+            if self.stems is None or os.path.splitext(f)[0] in self.stems:
+                self._submit(f)
+        concurrent.futures.wait(self.futures)
+        self._collect(retry=False)
+        self.executor.shutdown()
+        return self.analysis
+
+    def print_summary(self):
+        top_errors = self.analysis['top_errors']
+        sorted_top_n = sorted(top_errors, key=lambda k: top_errors[k], reverse=True)[:self.num_top_errors]
+        print("Live analysis")
+        print("=============")
+        print(f"Files analyzed = {self.files_analyzed}, resources = {self.analysis['total']}, "
+              f"gold = {self.analysis['gold_count']}")
+        for k in sorted_top_n:
+            print(f"{top_errors[k]} {k}")
+        print()
+
+    def _submit(self, f):
+        if f not in self.submitted:
+            self.submitted.add(f)
+            fn = functools.partial(analyze_file, params=self.params) if self.params else analyze_file
+            future = self.executor.submit(_call_with_metrics, fn, os.path.join(self.validation_dir, f))
+            self.futures[future] = f
+
+    def _collect(self, retry=True) -> bool:
+        done = [future for future in self.futures if future.done()]
+        for future in done:
+            f = self.futures.pop(future)
+            try:
+                analysis, snapshot = future.result()
+                metrics().merge(snapshot)
+                merge_analysis(self.analysis, analysis)
+                self.files_analyzed += 1
+            except Exception as e:
+                if retry:
+                    self.submitted.discard(f)
+                else:
+                    print(f"WARN: Failed to analyze {f}, error = {e}")
+        return bool(done)
+
+
+def analyze(validation_dir, num_top_errors, workers=1, use_cache=True, error_templates=False, examples_per_template=0,
+            from_export=False, stems=None, max_error_keys=MAX_ERROR_KEYS) -> typing.Dict:
+    examples_per_template = examples_per_template if error_templates else 0
+    params = {'error_templates': error_templates, 'examples_per_template': examples_per_template}
+    analysis = empty_analysis(examples_per_template, max_error_keys)
+    run_dir = os.path.dirname(os.path.normpath(validation_dir))
+    export = load_fresh_export(run_dir) if from_export else None
+    if export is not None:
+        merge_analysis(analysis, analyze_export(export, params, max_error_keys))
+        summarize(analysis, num_top_errors)
+        return analysis
+
+    file_names = [str(os.path.join(validation_dir, f)) for f in os.listdir(validation_dir)
+                  if stems is None or os.path.splitext(f)[0] in stems]
+    fn = analyze_file
+    kind = 'analyze'
+    if error_templates:
+        fn = functools.partial(analyze_file, params=params)
+        kind = f"analyze_templates_{examples_per_template}"
+    cache = open_cache(run_dir) if use_cache else None
+    for a in cached_map(fn, kind, file_names, num_workers(workers), cache):
+        merge_analysis(analysis, a)
+
+    summarize(analysis, num_top_errors)
+    return analysis
 
 
 def find_examples_subcmd(args):
-    examples = find_examples(args.run_dir, args.error_string, args.code, args.code_display, args.limit)
+    examples = find_examples(args.run_dir, args.error_string or [''], args.code or [], args.code_display or [],
+                             args.limit, args.workers)
     if examples:
         print(json.dumps(examples[:args.limit], indent=4))
     else:
         print("No examples found :-(")
 
 
-def find_examples(run_dir, error_str: str, code: str, code_display: str, num_examples: int):
+def find_examples(run_dir, error_strs: typing.List[str], codes: typing.List[str], code_displays: typing.List[str],
+                  num_examples: int, workers=1):
+    # Files that changed since the index was built are searched directly
     validation_files = os.listdir(os.path.join(run_dir, 'validated'))
-    examples_found = 0
     examples = []
-    done = False
-    for vf in validation_files:
-        validation_file = os.path.join(run_dir, 'validated', vf)
-        with open(validation_file, 'r') as f:
-            data = json.load(f)
-            for r in data:
-                if 'profile' in r:
-                    issues = r['validations']['issue']
-                    if any([i for i in issues if i['severity'] == 'error' and error_str in i['diagnostics']]):
-                        joined_resource = _join_resource_with_validation(run_dir, {vf: [r]})[0]
-                        if _does_code_or_display_match(joined_resource, code, code_display):
-                            examples.append(joined_resource)
-                            examples_found += 1
-                            if examples_found == num_examples:
-                                done = True
-                                break
-        if done:
+    index = open_index(run_dir)
+    if index is not None:
+        with contextlib.closing(index):
+            changed = _changed_index_files(index, run_dir)
+            examples = _find_examples_in_index(index, run_dir, error_strs, codes, code_displays, num_examples,
+                                               exclude_files=changed)
+        validation_files = [vf for vf in validation_files if vf in changed]
+        if len(examples) >= num_examples:
+            return examples
+
+    search_file = functools.partial(_find_examples_in_file, run_dir, tuple(error_strs), tuple(codes),
+                                    tuple(code_displays), num_examples)
+    for file_examples in parallel_map(search_file, validation_files, num_workers(workers)):
+        examples.extend(file_examples)
+        if len(examples) >= num_examples:
             break
 
-    return examples
-
-
-def _does_code_or_display_match(resource: typing.Dict, code: str, code_display: str) -> bool:
-    if code:
-        return 'code' in resource and 'coding' in resource['code'] and resource['code']['coding'][1]['code'] == code
-    elif code_display:
-        return 'code' in resource and 'coding' in resource['code'] and code_display in resource['code']['coding'][1]['display']
-    return True
+    return examples[:num_examples]
+
+
+def _find_examples_in_file(run_dir, error_strs: typing.Tuple[str], codes: typing.Tuple[str],
+                           code_displays: typing.Tuple[str], num_examples: int, vf) -> typing.List:
+    validation_file = os.path.join(run_dir, 'validated', vf)
+    assigned_file = os.path.join(run_dir, 'assigned', vf)
+    # Most files don't contain the strings at all, check the raw bytes before paying for JSON parsing
+    if not _file_may_contain(validation_file, error_strs):
+        return []
+    if (codes or code_displays) and not _file_may_contain(assigned_file, codes or code_displays):
+        return []
+
+    matches = []
+    for r in iter_json_array(validation_file):
+        if 'profile' in r:
+            issues = r['validations']['issue']
+            if any(i['severity'] == 'error' and any(e in i['diagnostics'] for e in error_strs) for i in issues):
+                matches.append(r)
+                # Without a code filter every match is an example
+                if not (codes or code_displays) and len(matches) == num_examples:
+                    break
+    if not matches:
+        return []
+
+    # One pass over the assigned file joins all matches, then restore the order of the validated file
+    order = {r['id']: n for n, r in enumerate(matches)}
+    joined = [resource for resource in _join_resource_with_validation(run_dir, {vf: matches})
+              if _does_code_or_display_match(resource, codes, code_displays)]
+    joined.sort(key=lambda resource: order[resource['id']])
+    return joined[:num_examples]
+
+
+def _file_may_contain(file_name, strs: typing.Iterable[str]) -> bool:
+    patterns = set()
+    for st in strs:
+        if not st:
+            return True
+        # The string can appear JSON escaped, with or without escaped non-ASCII characters and slashes
+        for escaped in (json.dumps(st)[1:-1], json.dumps(st, ensure_ascii=False)[1:-1]):
+            patterns.add(escaped.encode('utf-8'))
+            patterns.add(escaped.replace('/', '\\/').encode('utf-8'))
+    try:
+        with open(file_name, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return any(mm.find(p) != -1 for p in patterns)
+    except ValueError:
+        # Empty file, nothing to map
+        return False
+
+
+def _find_examples_in_index(index: sqlite3.Connection, run_dir, error_strs: typing.List[str],
+                            codes: typing.List[str], code_displays: typing.List[str],
+                            num_examples: int, exclude_files: typing.Set[str] = frozenset()) -> typing.List:
+    query = ('SELECT DISTINCT r.rowid, r.validated_file, r.validated_offset, r.assigned_offset '
+             'FROM resources r JOIN errors e ON e.resource_rowid = r.rowid '
+             'WHERE r.profile IS NOT NULL AND r.assigned_offset IS NOT NULL AND (' +
+             ' OR '.join(['instr(e.diagnostics, ?) > 0'] * len(error_strs)) + ')')
+    params = list(error_strs)
+    if exclude_files:
+        index.execute('CREATE TEMP TABLE excluded_files (validated_file TEXT PRIMARY KEY)')
+        index.executemany('INSERT INTO excluded_files VALUES (?)', [(vf,) for vf in exclude_files])
+        query += ' AND r.validated_file NOT IN (SELECT validated_file FROM excluded_files)'
+    if codes:
+        query += ' AND r.code IN (' + ', '.join(['?'] * len(codes)) + ')'
+        params.extend(codes)
+    elif code_displays:
+        query += ' AND (' + ' OR '.join(['instr(r.display, ?) > 0'] * len(code_displays)) + ')'
+        params.extend(code_displays)
+    query += ' ORDER BY r.rowid LIMIT ?'
+    params.append(num_examples)
+    return [_read_indexed_resource(run_dir, vf, v_offset, a_offset)
+            for _, vf, v_offset, a_offset in index.execute(query, params)]
+
+
+def _does_code_or_display_match(resource: typing.Dict, codes: typing.Sequence[str],
+                                code_displays: typing.Sequence[str]) -> bool:
+    if not codes and not code_displays:
+        return True
+    if 'code' not in resource or 'coding' not in resource['code'] or len(resource['code']['coding']) < 2:
+        return False
+    translated = resource['code']['coding'][1]
+    if codes:
+        return translated.get('code') in codes
+    return any(d in translated.get('display', '') for d in code_displays)
 
 
 def _join_resource_with_validation(run_dir, validation_resources: typing.Dict) -> typing.List:
     example_resources = []
     for fname, example_rs in validation_resources.items():
-        ids = [r['id'] for r in example_rs]
+        by_id = {r['id']: r for r in example_rs}
         assigned_file = os.path.join(run_dir, 'assigned', fname)
-        with open(assigned_file, 'r') as f:
-            data = json.load(f)
-            for e in data['entry']:
-                if e['resource']['id'] in ids:
-                    resource = e['resource']
-                    v = [v for v in example_rs if v['id'] == resource['id']][0]
-                    resource['validations'] = v['validations']
-                    example_resources.append(resource)
+        for e in iter_json_array(assigned_file, key='entry'):
+            v = by_id.get(e['resource']['id'])
+            if v is not None:
+                resource = e['resource']
+                resource['validations'] = v['validations']
+                example_resources.append(resource)
     return example_resources
 
 
+def _read_indexed_resource(run_dir, validated_file: str, validated_offset: int, assigned_offset: int) -> typing.Dict:
+    v = read_json_at(os.path.join(run_dir, 'validated', validated_file), validated_offset)
+    resource = read_json_at(os.path.join(run_dir, 'assigned', validated_file), assigned_offset)['resource']
+    resource['validations'] = v['validations']
+    return resource
+
+
 def find_resource_by_id_subcmd(args):
     examples = find_resource_by_id(args.run_dir, args.id)
     if examples:
@@ -321,66 +1669,550 @@ def find_resource_by_id_subcmd(args):
 
 
 def find_resource_by_id(run_dir, resource_id):
+    # Files that changed since the index was built are scanned directly
     validation_files = os.listdir(os.path.join(run_dir, 'validated'))
-    result = None
+    index = open_index(run_dir)
+    if index is not None:
+        with contextlib.closing(index):
+            changed = _changed_index_files(index, run_dir)
+            rows = index.execute('SELECT validated_file, validated_offset, assigned_offset FROM resources '
+                                 'WHERE id = ? AND validated_offset IS NOT NULL AND assigned_offset IS NOT NULL '
+                                 'ORDER BY rowid', (resource_id,)).fetchall()
+        for row in rows:
+            if row[0] not in changed:
+                return [_read_indexed_resource(run_dir, *row)]
+        validation_files = [vf for vf in validation_files if vf in changed]
+
     for vf in validation_files:
         validation_file = os.path.join(run_dir, 'validated', vf)
-        with open(validation_file, 'r') as f:
-            data = json.load(f)
-            for r in data:
-                if r['id'] == resource_id:
-                    result = {vf: [r]}
-                    break
+        for r in iter_json_array(validation_file):
+            if r['id'] == resource_id:
+                return _join_resource_with_validation(run_dir, {vf: [r]})
+    return []
+
+
+def open_index(run_dir) -> typing.Optional[sqlite3.Connection]:
+    index_file = os.path.join(run_dir, INDEX_FILE_NAME)
+    if not os.path.exists(index_file):
+        return None
+    conn = sqlite3.connect(index_file)
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'files'").fetchall():
+        print(f"WARN: {index_file} was built by an older version and can't be checked for changed files, "
+              f"ignoring it, run index to rebuild it")
+        conn.close()
+        return None
+    return conn
+
+
+def _changed_index_files(index: sqlite3.Connection, run_dir) -> typing.Set[str]:
+    recorded = {vf: tuple(st) for vf, *st in index.execute(
+        'SELECT validated_file, validated_size, validated_mtime_ns, assigned_size, assigned_mtime_ns FROM files')}
+    changed = _changed_run_files(run_dir, recorded)
+    if changed:
+        print(f"WARN: {len(changed)} files changed since {INDEX_FILE_NAME} was built, reading them directly, "
+              f"run index to update it")
+    return changed
+
+
+def _run_file_names(run_dir) -> typing.List[str]:
+    # Validated files, then assigned files without a validated counterpart
+    file_names = os.listdir(os.path.join(run_dir, 'validated'))
+    assigned_dir = os.path.join(run_dir, 'assigned')
+    if os.path.isdir(assigned_dir):
+        validated = set(file_names)
+        file_names += [af for af in os.listdir(assigned_dir) if af not in validated]
+    return file_names
+
+
+def _run_file_stats(run_dir, file_names: typing.List[str]) -> typing.Dict[str, typing.Tuple]:
+    # (size, mtime_ns) of each validated file followed by those of its assigned file, None for a missing file
+    stats = {}
+    for vf in file_names:
+        st = []
+        for d in ('validated', 'assigned'):
+            try:
+                stat = os.stat(os.path.join(run_dir, d, vf))
+                st.extend((stat.st_size, stat.st_mtime_ns))
+            except FileNotFoundError:
+                st.extend((None, None))
+        stats[vf] = tuple(st)
+    return stats
+
 
-    return _join_resource_with_validation(run_dir, result)
+def _changed_run_files(run_dir, recorded: typing.Dict[str, typing.Tuple]) -> typing.Set[str]:
+    # Files that were added, changed or removed in validated or assigned since recorded was taken
+    current = _run_file_stats(run_dir, _run_file_names(run_dir))
+    return {vf for vf in current.keys() | recorded.keys() if current.get(vf) != recorded.get(vf)}
+
+
+def build_index_subcmd(args):
+    build_index(args.run_dir, args.workers)
+
+
+def build_index(run_dir, workers=1):
+    validation_files = _run_file_names(run_dir)
+    index_file = os.path.join(run_dir, INDEX_FILE_NAME)
+    tmp_file = index_file + '.tmp'
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+
+    start = time.time()
+    rowid = 0
+    # Stats are taken before the files are read, so a file written while indexing shows up as changed later
+    stats = _run_file_stats(run_dir, validation_files)
+    conn = sqlite3.connect(tmp_file)
+    with contextlib.closing(conn):
+        conn.executescript(INDEX_SCHEMA)
+        conn.executemany('INSERT INTO files (validated_file, validated_size, validated_mtime_ns, assigned_size, '
+                         'assigned_mtime_ns) VALUES (?, ?, ?, ?, ?)', [(vf,) + st for vf, st in stats.items()])
+        index_file_fn = functools.partial(_index_file, run_dir)
+        for rows in parallel_map(index_file_fn, validation_files, num_workers(workers)):
+            resources = []
+            errors = []
+            for row, diagnostics in rows:
+                rowid += 1
+                resources.append((rowid,) + row)
+                errors.extend((rowid, d) for d in diagnostics)
+            conn.executemany('INSERT INTO resources (rowid, id, validated_file, validated_offset, assigned_offset, '
+                             'resource_type, profile, error_count, system, code, display, matched) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', resources)
+            conn.executemany('INSERT INTO errors (resource_rowid, diagnostics) VALUES (?, ?)', errors)
+        conn.executescript(INDEX_INDEXES)
+        conn.commit()
+    os.replace(tmp_file, index_file)
+    time_taken = time.time() - start
+    print(f"INFO: Indexed {rowid} resources from {len(validation_files)} files in {time_taken:.2f} seconds")
+
+
+def _index_file(run_dir, vf: str) -> typing.List[typing.Tuple]:
+    # Map each resource id to its entry in the assigned file first, then emit one row per validated resource.
+    # Either file may be missing.
+    assigned = {}
+    assigned_file = os.path.join(run_dir, 'assigned', vf)
+    if os.path.exists(assigned_file):
+        for offset, e in iter_json_array(assigned_file, key='entry', with_offsets=True):
+            resource = e['resource']
+            system = code = display = None
+            if 'code' in resource and 'coding' in resource['code'] and len(resource['code']['coding']) > 1:
+                translated = resource['code']['coding'][1]
+                system, code, display = translated.get('system'), translated.get('code'), translated.get('display')
+            matched = 1 if 'meta' in resource and 'profile' in resource['meta'] else 0
+            assigned[resource['id']] = (offset, resource.get('resourceType'), system, code, display, matched)
+
+    rows = []
+    validation_file = os.path.join(run_dir, 'validated', vf)
+    validated = iter_json_array(validation_file, with_offsets=True) if os.path.exists(validation_file) else ()
+    for offset, r in validated:
+        errors = [i['diagnostics'] for i in r.get('validations', {}).get('issue', []) if i['severity'] == 'error']
+        a_offset, resource_type, system, code, display, matched = \
+            assigned.pop(r['id'], (None, r.get('resourceType'), None, None, None, 0))
+        rows.append(((r['id'], vf, offset, a_offset, resource_type, r.get('profile'), len(errors), system, code,
+                      display, matched), errors))
+    for resource_id, (a_offset, resource_type, system, code, display, matched) in assigned.items():
+        rows.append(((resource_id, vf, None, a_offset, resource_type, None, 0, system, code, display, matched), []))
+    return rows
+
+
+def export_run_subcmd(args):
+    export_run(args.run_dir, args.workers)
+
+
+def export_run(run_dir, workers=1):
+    # Flattens a run into one array per column, strings are stored once in a dictionary and referenced by
+    # position. Diagnostics of row n are diagnostics[error_offsets[n]:error_offsets[n + 1]].
+    validation_files = _run_file_names(run_dir)
+    start = time.time()
+    stats = _run_file_stats(run_dir, validation_files)
+    strings = []
+    string_ids = {}
+
+    def intern(st):
+        if st is None:
+            return EXPORT_NONE
+        i = string_ids.get(st)
+        if i is None:
+            i = string_ids[st] = len(strings)
+            strings.append(st)
+        return i
+
+    columns = {name: array.array(typecode) for name, typecode in EXPORT_COLUMNS.items()}
+    columns['error_offsets'].append(0)
+    for rows in parallel_map(functools.partial(_index_file, run_dir), validation_files, num_workers(workers)):
+        for (resource_id, vf, v_offset, a_offset, resource_type, profile, error_count, system, code, display,
+             matched), diagnostics in rows:
+            columns['id'].append(intern(resource_id))
+            columns['file'].append(intern(vf))
+            columns['validated_offset'].append(EXPORT_NO_OFFSET if v_offset is None else v_offset)
+            columns['assigned_offset'].append(EXPORT_NO_OFFSET if a_offset is None else a_offset)
+            columns['resource_type'].append(intern(resource_type))
+            columns['profile'].append(intern(profile))
+            columns['error_count'].append(error_count)
+            columns['diagnostics'].extend(intern(d) for d in diagnostics)
+            columns['error_offsets'].append(len(columns['diagnostics']))
+            columns['system'].append(intern(system))
+            columns['code'].append(intern(code))
+            columns['display'].append(intern(display))
+            columns['matched'].append(matched)
+
+    export_dir = os.path.join(run_dir, EXPORT_DIR_NAME)
+    tmp_dir = export_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.mkdir(tmp_dir)
+    for name, column in columns.items():
+        with open(os.path.join(tmp_dir, name + '.bin'), 'wb') as f:
+            column.tofile(f)
+    with open(os.path.join(tmp_dir, 'strings.json'), 'w') as f:
+        json.dump(strings, f)
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump({'rows': len(columns['id']), 'byteorder': sys.byteorder,
+                   'columns': {name: [c.typecode, c.itemsize] for name, c in columns.items()}, 'files': stats}, f)
+    shutil.rmtree(export_dir, ignore_errors=True)
+    os.replace(tmp_dir, export_dir)
+    time_taken = time.time() - start
+    size_mb = sum(os.path.getsize(os.path.join(export_dir, f)) for f in os.listdir(export_dir)) / (1024 * 1024)
+    print(f"INFO: Exported {len(columns['id'])} resources from {len(validation_files)} files "
+          f"({size_mb:.1f} MB) in {time_taken:.2f} seconds")
+
+
+class RunExport:
+    def __init__(self, strings: typing.List[str], columns: typing.Dict[str, array.array]):
+        self.strings = strings
+        self.columns = columns
+        self.rows = len(columns['id'])
+
+    @classmethod
+    def load(cls, run_dir) -> 'RunExport':
+        export_dir = os.path.join(run_dir, EXPORT_DIR_NAME)
+        with open(os.path.join(export_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        with open(os.path.join(export_dir, 'strings.json'), 'r') as f:
+            strings = json.load(f)
+        columns = {}
+        for name, (typecode, itemsize) in meta['columns'].items():
+            column = array.array(typecode)
+            if column.itemsize != itemsize:
+                raise ValueError(f"Export column {name} has {itemsize} byte items, this platform uses {column.itemsize}")
+            with open(os.path.join(export_dir, name + '.bin'), 'rb') as f:
+                column.frombytes(f.read())
+            if meta['byteorder'] != sys.byteorder:
+                column.byteswap()
+            columns[name] = column
+        return cls(strings, columns)
+
+    def string(self, i: int) -> typing.Optional[str]:
+        return self.strings[i] if i != EXPORT_NONE else None
+
+
+def load_fresh_export(run_dir) -> typing.Optional[RunExport]:
+    # None if there is no export or the run files changed since it was written, the caller then reads them directly
+    meta_file = os.path.join(run_dir, EXPORT_DIR_NAME, 'meta.json')
+    if not os.path.exists(meta_file):
+        print(f"WARN: {run_dir} has not been exported, reading the run files instead, run export to use --from-export")
+        return None
+    with open(meta_file, 'r') as f:
+        meta = json.load(f)
+    if 'files' not in meta:
+        print(f"WARN: {EXPORT_DIR_NAME}/ in {run_dir} was written by an older version and can't be checked for "
+              f"changed files, reading the run files instead, run export to rewrite it")
+        return None
+    changed = _changed_run_files(run_dir, {vf: tuple(st) for vf, st in meta['files'].items()})
+    if changed:
+        print(f"WARN: {len(changed)} files changed since {EXPORT_DIR_NAME}/ in {run_dir} was written, reading the "
+              f"run files instead, run export to update it")
+        return None
+    return RunExport.load(run_dir)
+
+
+def analyze_export(export: RunExport, params=None, max_error_keys=0) -> typing.Dict:
+    # Same result as analyze_file over all validated files, in the same order. The whole run is one pass, so
+    # top_errors is pruned along the way like merge_analysis does.
+    params = params or {}
+    error_templates = params.get('error_templates', False)
+    examples_per_template = params.get('examples_per_template', 0)
+    c = export.columns
+    total_resources = 0
+    profile_assigned = 0
+    pruned = {'top_errors': collections.defaultdict(int), 'error_examples': collections.defaultdict(list),
+              'other_errors': 0}
+    all_errors = pruned['top_errors']
+    error_examples = pruned['error_examples']
+    gold = []
+    keys = {}
+    for n in range(export.rows):
+        if c['validated_offset'][n] == EXPORT_NO_OFFSET:
+            continue
+        total_resources += 1
+        if c['profile'][n] == EXPORT_NONE:
+            continue
+        profile_assigned += 1
+        if c['error_count'][n] == 0:
+            gold.append(export.strings[c['id'][n]])
+        for d in c['diagnostics'][c['error_offsets'][n]:c['error_offsets'][n + 1]]:
+            k = keys.get(d)
+            if k is None:
+                k = keys[d] = normalize_diagnostic(export.strings[d]) if error_templates else export.strings[d]
+            if error_templates:
+                examples = error_examples[k]
+                if len(examples) < examples_per_template and export.strings[d] not in examples:
+                    examples.append(export.strings[d])
+            all_errors[k] += 1
+        if max_error_keys and len(all_errors) > 2 * max_error_keys:
+            _prune_top_errors(pruned, max_error_keys)
+            all_errors = pruned['top_errors']
+            error_examples = pruned['error_examples']
+
+    result = {
+        'total': total_resources,
+        'profile_assigned': profile_assigned,
+        'gold': gold,
+        'top_errors': all_errors,
+        'other_errors': pruned['other_errors']
+    }
+    if examples_per_template:
+        result['error_examples'] = {k: v for k, v in error_examples.items() if v}
+    return result
+
+
+def matched_unmatched_export(export: RunExport) -> typing.Dict:
+    result = {'matched': collections.defaultdict(int), 'unmatched': collections.defaultdict(int)}
+    c = export.columns
+    observation = export.strings.index('Observation') if 'Observation' in export.strings else None
+    for n in range(export.rows):
+        if c['assigned_offset'][n] == EXPORT_NO_OFFSET or c['resource_type'][n] != observation \
+                or c['system'][n] == EXPORT_NONE:
+            continue
+        key = (export.string(c['system'][n]), export.string(c['code'][n]), export.string(c['display'][n]))
+        result['matched' if c['matched'][n] else 'unmatched'][key] += 1
+    return result
+
+
+def least_errors_export(export: RunExport, run_dir, exclude_error_strings: typing.List[str], top_k=1) -> typing.List:
+    if top_k < 1:
+        return []
+    c = export.columns
+    excluded = _exclusion_matcher(tuple(exclude_error_strings))
+    excluded_ids = {}
+    heap = []
+    for n in range(export.rows):
+        if c['profile'][n] == EXPORT_NONE or c['error_count'][n] == 0 or c['assigned_offset'][n] == EXPORT_NO_OFFSET:
+            continue
+        if excluded:
+            is_excluded = False
+            for d in c['diagnostics'][c['error_offsets'][n]:c['error_offsets'][n + 1]]:
+                if d not in excluded_ids:
+                    excluded_ids[d] = bool(excluded.search(export.strings[d]))
+                if excluded_ids[d]:
+                    is_excluded = True
+                    break
+            if is_excluded:
+                continue
+        _push_bounded(heap, top_k, (-c['error_count'][n], -n), n)
+        if len(heap) == top_k and -heap[0][0][0] == 1:
+            break
+    best = [n for _, n in sorted(heap, reverse=True)]
+    return [_read_indexed_resource(run_dir, export.strings[c['file'][n]], c['validated_offset'][n],
+                                   c['assigned_offset'][n]) for n in best]
+
+
+def compare_subcmd(args):
+    report = compare_runs(args.run_dir_a, args.run_dir_b, args.workers, args.tmp_dir)
+    print_comparison(report, args.num_top)
+
+
+def compare_runs(run_dir_a, run_dir_b, workers=1, tmp_dir=None) -> typing.Dict:
+    # Both runs are flattened into on-disk SQLite tables at the same time, then merge-joined in id order,
+    # so memory stays bounded by a single file and the per-template / per-coding counters
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as d:
+        db_a = os.path.join(d, 'a.sqlite')
+        db_b = os.path.join(d, 'b.sqlite')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            future_a = executor.submit(_extract_run_for_compare, run_dir_a, db_a, workers)
+            future_b = executor.submit(_extract_run_for_compare, run_dir_b, db_b, workers)
+            templates_a = future_a.result()
+            templates_b = future_b.result()
+
+        report = {
+            'only_in_a': 0,
+            'only_in_b': 0,
+            'gold_gained': 0,
+            'gold_lost': 0,
+            'gold_gained_ids': [],
+            'gold_lost_ids': [],
+            'newly_matched': collections.Counter(),
+            'newly_unmatched': collections.Counter(),
+            'new_templates': {t: n for t, n in templates_b.items() if t not in templates_a},
+            'resolved_templates': {t: n for t, n in templates_a.items() if t not in templates_b},
+            'changed_templates': {t: templates_b[t] - n for t, n in templates_a.items()
+                                  if t in templates_b and templates_b[t] != n},
+        }
+        conn_a = sqlite3.connect(db_a)
+        conn_b = sqlite3.connect(db_b)
+        with contextlib.closing(conn_a), contextlib.closing(conn_b):
+            query = 'SELECT id, gold, system, code, display, matched FROM resources ORDER BY id, rowid'
+            rows_a = conn_a.execute(query)
+            rows_b = conn_b.execute(query)
+            a = next(rows_a, None)
+            b = next(rows_b, None)
+            while a is not None or b is not None:
+                if b is None or (a is not None and a[0] < b[0]):
+                    report['only_in_a'] += 1
+                    a = next(rows_a, None)
+                elif a is None or b[0] < a[0]:
+                    report['only_in_b'] += 1
+                    b = next(rows_b, None)
+                else:
+                    _compare_resource(report, a, b)
+                    a = next(rows_a, None)
+                    b = next(rows_b, None)
+    return report
+
+
+def _compare_resource(report: typing.Dict, a: typing.Tuple, b: typing.Tuple):
+    resource_id, gold_a, system_a, code_a, display_a, matched_a = a
+    _, gold_b, system_b, code_b, display_b, matched_b = b
+    if gold_b and not gold_a:
+        report['gold_gained'] += 1
+        if len(report['gold_gained_ids']) < GOLD_SAMPLE_SIZE:
+            report['gold_gained_ids'].append(resource_id)
+    elif gold_a and not gold_b:
+        report['gold_lost'] += 1
+        if len(report['gold_lost_ids']) < GOLD_SAMPLE_SIZE:
+            report['gold_lost_ids'].append(resource_id)
+    if system_b is not None and matched_b and not matched_a:
+        report['newly_matched'][(system_b, code_b, display_b)] += 1
+    elif system_a is not None and matched_a and not matched_b:
+        report['newly_unmatched'][(system_a, code_a, display_a)] += 1
+
+
+def _extract_run_for_compare(run_dir, db_file, workers) -> typing.Dict[str, int]:
+    templates = collections.Counter()
+    validation_files = os.listdir(os.path.join(run_dir, 'validated'))
+    conn = sqlite3.connect(db_file)
+    with contextlib.closing(conn):
+        conn.execute('CREATE TABLE resources (id TEXT NOT NULL, gold INTEGER NOT NULL, system TEXT, code TEXT, '
+                     'display TEXT, matched INTEGER NOT NULL)')
+        for rows in parallel_map(functools.partial(_index_file, run_dir), validation_files, num_workers(workers)):
+            resources = []
+            for (resource_id, _, v_offset, _, _, profile, error_count, system, code, display,
+                 matched), diagnostics in rows:
+                if profile is not None:
+                    templates.update(normalize_diagnostic(d) for d in diagnostics)
+                gold = 1 if v_offset is not None and profile is not None and error_count == 0 else 0
+                resources.append((resource_id, gold, system, code, display, matched))
+            conn.executemany('INSERT INTO resources VALUES (?, ?, ?, ?, ?, ?)', resources)
+        conn.execute('CREATE INDEX resources_id ON resources (id)')
+        conn.commit()
+    return templates
+
+
+def print_comparison(report: typing.Dict, num_top: int):
+    print(f"Resources only in A = {report['only_in_a']}\nResources only in B = {report['only_in_b']}")
+    print(f"Gold gained = {report['gold_gained']}\nGold lost = {report['gold_lost']}")
+    if report['gold_gained_ids']:
+        print(f"Some resource ids of gained gold: {','.join(report['gold_gained_ids'])}")
+    if report['gold_lost_ids']:
+        print(f"Some resource ids of lost gold: {','.join(report['gold_lost_ids'])}")
+
+    for title, templates in (('New errors', report['new_templates']),
+                             ('Resolved errors', report['resolved_templates']),
+                             ('Changed error counts', report['changed_templates'])):
+        print()
+        print(f"{title} ({len(templates)} templates)")
+        print("=============")
+        for t in sorted(templates, key=lambda k: abs(templates[k]), reverse=True)[:num_top]:
+            print(f"{templates[t]:+d} {t}" if title.startswith('Changed') else f"{templates[t]} {t}")
+
+    for title, codings in (('Codings that now match CEM profiles', report['newly_matched']),
+                           ('Codings that no longer match CEM profiles', report['newly_unmatched'])):
+        print()
+        print(title)
+        print("=============")
+        print('%-10s ' % 'code', '%-16s' % 'system', '%-40s' % 'display', 'resources')
+        for (system, code, display), num in codings.most_common(num_top):
+            print('%-10s ' % code, '%-16s' % system, '%-40s' % display, num)
 
 
 def find_least_errors_subcmd(args):
-    examples = find_resources_with_least_errors(args.run_dir, args.exclude_error_strings)
+    export = load_fresh_export(args.run_dir) if args.from_export else None
+    if export is not None:
+        examples = least_errors_export(export, args.run_dir, args.exclude_error_strings, args.top_k)
+    else:
+        examples = find_resources_with_least_errors(args.run_dir, args.exclude_error_strings, args.top_k, args.workers)
     if examples:
         print(json.dumps(examples, indent=4))
     else:
         print("No examples found :-(")
 
 
-def find_resources_with_least_errors(run_dir, exclude_error_strings: typing.List[str]) -> typing.List:
+def find_resources_with_least_errors(run_dir, exclude_error_strings: typing.List[str], top_k=1,
+                                     workers=1) -> typing.List:
+    # Each file keeps a bounded max-heap of its top_k candidates, ordered by (errors, file, position), and the
+    # per-file heaps are merged in file order. Gold resources are skipped, so once top_k resources with a single
+    # error are found nothing later can beat them and the scan stops.
+    if top_k < 1:
+        return []
     validation_files = os.listdir(os.path.join(run_dir, 'validated'))
-    done = False
-    min_errors_found = 99999
-    the_vf = None
-    the_r = None
-    for vf in validation_files:
-        validation_file = os.path.join(run_dir, 'validated', vf)
-        with open(validation_file, 'r') as f:
-            data = json.load(f)
-            for r in data:
-                exclude_resource = False
-                if 'profile' in r:
-                    issues = r['validations']['issue']
-                    errors = [i for i in issues if i['severity'] == 'error']
-                    if len(errors) == 0:
-                        # We don't want gold
-                        continue
-                    for excluded in exclude_error_strings:
-                        if any([i for i in errors if excluded in i['diagnostics']]):
-                            exclude_resource = True
-                            break
-                    if exclude_resource:
-                        continue
-                    if len(errors) < min_errors_found:
-                        min_errors_found = len(errors)
-                        the_r = r
-                        the_vf = vf
-                    if min_errors_found == 1:
-                        done = True
-                        break
-        if done:
+    scan_file = functools.partial(_least_errors_in_file, run_dir, tuple(exclude_error_strings), top_k)
+    heap = []
+    for file_idx, candidates in enumerate(parallel_map(scan_file, validation_files, num_workers(workers))):
+        for num_errors, pos, r in candidates:
+            _push_bounded(heap, top_k, (-num_errors, -file_idx, -pos), (validation_files[file_idx], r))
+        if len(heap) == top_k and -heap[0][0][0] == 1:
             break
-    return _join_resource_with_validation(run_dir, {the_vf: [the_r]})
+
+    best = sorted(heap, key=lambda h: h[0], reverse=True)
+    by_file = collections.defaultdict(list)
+    for _, (vf, r) in best:
+        by_file[vf].append(r)
+    joined = {}
+    for vf, rs in by_file.items():
+        for resource in _join_resource_with_validation(run_dir, {vf: rs}):
+            joined[(vf, resource['id'])] = resource
+    return [joined[(vf, r['id'])] for _, (vf, r) in best if (vf, r['id']) in joined]
+
+
+def _least_errors_in_file(run_dir, exclude_error_strings: typing.Tuple[str], top_k: int, vf) -> typing.List:
+    excluded = _exclusion_matcher(exclude_error_strings)
+    heap = []
+    for pos, r in enumerate(iter_json_array(os.path.join(run_dir, 'validated', vf))):
+        if 'profile' not in r:
+            continue
+        num_errors = 0
+        for i in r['validations']['issue']:
+            if i['severity'] == 'error':
+                if excluded and excluded.search(i['diagnostics']):
+                    break
+                num_errors += 1
+        else:
+            # We don't want gold
+            if num_errors:
+                _push_bounded(heap, top_k, (-num_errors, -pos), r)
+                if len(heap) == top_k and -heap[0][0][0] == 1:
+                    break
+    return [(-key[0], -key[1], r) for key, r in heap]
+
+
+def _push_bounded(heap: typing.List, size: int, key: typing.Tuple, item):
+    # heap[0] is the worst of the kept items, keys are negated so the smallest key is the worst
+    if len(heap) < size:
+        heapq.heappush(heap, (key, item))
+    elif key > heap[0][0]:
+        heapq.heapreplace(heap, (key, item))
+
+
+@functools.lru_cache(maxsize=32)
+def _exclusion_matcher(exclude_error_strings: typing.Tuple[str]) -> typing.Optional[typing.Pattern]:
+    if not exclude_error_strings:
+        return None
+    return re.compile('|'.join(re.escape(e) for e in sorted(set(exclude_error_strings))))
 
 
 def show_matched_unmatched_subcmd(args):
-    result = find_matched_unmatched(args.run_dir)
+    export = load_fresh_export(args.run_dir) if args.from_export else None
+    if export is not None:
+        result = matched_unmatched_export(export)
+    else:
+        result = find_matched_unmatched(args.run_dir, args.workers, use_cache=not args.no_cache)
     print("Resources that matched CEM profiles:")
     print('%-10s ' % 'code', '%-16s' % 'system', '%-40s' % 'display')
     #print('%-10s ' % '-' * len('code'), '%-16s' % '-' * len('system'), '%-40s' % '-' * len('display'))
@@ -397,31 +2229,39 @@ def show_matched_unmatched_subcmd(args):
         print('%-10s ' % code, '%-16s' % system, '%-40s' % display)
 
 
-def find_matched_unmatched(run_dir) -> typing.Dict:
+def find_matched_unmatched(run_dir, workers=1, use_cache=False) -> typing.Dict:
     result = {'matched': collections.defaultdict(int), 'unmatched': collections.defaultdict(int)}
     assigned_dir = os.path.join(run_dir, 'assigned')
-    assigned_files = os.listdir(assigned_dir)
+    assigned_files = [os.path.join(assigned_dir, af) for af in os.listdir(assigned_dir)]
+    cache = open_cache(run_dir) if use_cache else None
 
-    for af in assigned_files:
-        assigned_file = os.path.join(assigned_dir, af)
-        with open(assigned_file, 'r') as f:
-            data = json.load(f)
-            for e in data['entry']:
-                resource = e['resource']
-                if resource['resourceType'] == 'Observation' and 'code' in resource and 'coding' in resource['code']:
-                    coding = resource['code']['coding']
-                    if len(coding) > 1:
-                        translated = coding[1]
-                        key = (translated['system'], translated['code'], translated['display'])
-                        matched = 'meta' in resource and 'profile' in resource['meta']
-                        if matched:
-                            result['matched'][key] += 1
-                        else:
-                            result['unmatched'][key] += 1
+    for partial in cached_map(matched_unmatched_file, 'matched_unmatched', assigned_files, num_workers(workers), cache):
+        for k in ('matched', 'unmatched'):
+            for system, code, display, num in partial[k]:
+                result[k][(system, code, display)] += num
 
     return result
 
 
+def matched_unmatched_file(assigned_file: str) -> typing.Dict:
+    # Counts are returned as [system, code, display, count] lists so they can be cached as JSON
+    result = {'matched': collections.defaultdict(int), 'unmatched': collections.defaultdict(int)}
+    for e in iter_json_array(assigned_file, key='entry'):
+        resource = e['resource']
+        if resource['resourceType'] == 'Observation' and 'code' in resource and 'coding' in resource['code']:
+            coding = resource['code']['coding']
+            if len(coding) > 1:
+                translated = coding[1]
+                key = (translated['system'], translated['code'], translated['display'])
+                matched = 'meta' in resource and 'profile' in resource['meta']
+                if matched:
+                    result['matched'][key] += 1
+                else:
+                    result['unmatched'][key] += 1
+
+    return {k: [list(key) + [num] for key, num in counts.items()] for k, counts in result.items()}
+
+
 def csv(s):
     result = []
     if s:
@@ -430,45 +2270,180 @@ def csv(s):
 
 
 def post_validation_notifications_subcmd(args):
-    post_validation_notifications(args.run_dir, args.tracking_service_base_url, args.client_id)
-
-
-def post_validation_notifications(run_dir, base_url, client_id):
-    track_req = _create_request(client_id, base_url)
+    configure_tracking_client(pool_size=args.workers, max_retries=args.max_retries)
+    post_validation_notifications(args.run_dir, args.tracking_service_base_url, args.client_id, args.workers,
+                                  args.resume, post_terms=not args.no_terminology)
+
+
+class TrackingJournal:
+    # Append-only record of tracking ids created by post-notifications, one JSON object per line, so an
+    # interrupted run can be resumed without creating the same requests, segments or destinations again
+    def __init__(self, journal_file, resume=False):
+        self.request_id = None
+        self.segments = {}
+        self.sources = {}
+        self.terms_posted = set()
+        self.destinations = {}
+        self.notified = set()
+        if resume and os.path.exists(journal_file):
+            # Cut off a torn last line, otherwise the next record would be appended to it and lost as well
+            os.truncate(journal_file, self._load(journal_file))
+        elif os.path.exists(journal_file):
+            print(f"WARN: Overwriting journal {journal_file}, use --resume to continue the earlier run instead")
+        self.f = open(journal_file, 'a' if resume else 'w')
+        self.lock = threading.Lock()
+
+    def _load(self, journal_file) -> int:
+        # Returns the size of the complete lines
+        end = 0
+        with open(journal_file, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Torn last line of a killed run
+                    break
+                end += len(line)
+                try:
+                    rec = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                t = rec['type']
+                if t == 'request':
+                    self.request_id = rec['id']
+                elif t == 'segment':
+                    self.segments[rec['file']] = rec['id']
+                elif t == 'source':
+                    self.sources[rec['file']] = rec['id']
+                elif t == 'terms':
+                    self.terms_posted.add(rec['file'])
+                elif t == 'destination':
+                    self.destinations[(rec['file'], rec['resource'])] = rec['id']
+                elif t == 'notified':
+                    self.notified.add((rec['file'], rec['resource']))
+                    self.destinations.pop((rec['file'], rec['resource']), None)
+        return end
+
+    def record(self, **rec):
+        line = json.dumps(rec) + '\n'
+        with self.lock:
+            self.f.write(line)
+            self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+def post_validation_notifications(run_dir, base_url, client_id, workers=1, resume=False, post_terms=True):
+    # The tracking-service takes notifications for one reference per call, so requests are spread over a thread
+    # pool instead of batched: per-file segment/source setup and per-resource destination + notifications are
+    # separate tasks, and resource tasks wait for their file's setup task, which is always queued before them.
+    journal = TrackingJournal(os.path.join(run_dir, TRACKING_JOURNAL_FILE_NAME), resume)
+    with contextlib.closing(journal):
+        _post_validation_notifications(run_dir, base_url, client_id, workers, journal, post_terms)
+
+
+def _post_validation_notifications(run_dir, base_url, client_id, workers, journal: TrackingJournal, post_terms=True):
+    req_id = journal.request_id
+    if req_id is None:
+        req_id = _create_request(client_id, base_url)['id']
+        journal.record(type='request', id=req_id)
+    validation_files = os.listdir(os.path.join(run_dir, 'validated'))
+    start = time.time()
+    requests_before = tracking_client().requests_sent
+    resources_posted = 0
+    resources_skipped = 0
+    errors = []
+    in_flight = threading.BoundedSemaphore(workers * 8)
+
+    def on_done(future):
+        in_flight.release()
+        if future.exception() is not None:
+            errors.append(future.exception())
+
+    def submit(executor, fn, *fn_args):
+        in_flight.acquire()
+        future = executor.submit(fn, *fn_args)
+        future.add_done_callback(on_done)
+        return future
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for vf in validation_files:
+            if errors:
+                break
+            source_future = submit(executor, _post_file_tracking, run_dir, base_url, vf, req_id, client_id, journal,
+                                   post_terms)
+            validation_file = os.path.join(run_dir, 'validated', vf)
+            for r in iter_json_array(validation_file):
+                if errors:
+                    break
+                if (vf, r['id']) in journal.notified:
+                    resources_skipped += 1
+                    continue
+                submit(executor, _post_resource_validations, r, vf, source_future, client_id, base_url, journal)
+                resources_posted += 1
+    if errors:
+        raise errors[0]
+    if resources_skipped:
+        print(f"INFO: Skipped {resources_skipped} resources already posted according to the journal")
+
+    time_taken = time.time() - start
+    num_requests = tracking_client().requests_sent - requests_before
+    print(f"INFO: Posted validations of {resources_posted} resources from {len(validation_files)} files in "
+          f"{time_taken:.2f} seconds ({resources_posted / max(time_taken, 1e-9):.1f} resources/s, "
+          f"{num_requests / max(time_taken, 1e-9):.1f} requests/s)")
+
+
+def _post_file_tracking(run_dir, base_url, vf, req_id, client_id, journal: TrackingJournal, post_terms=True):
+    seg_id = journal.segments.get(vf)
+    if seg_id is None:
+        seg_id = _create_segment(req_id, client_id, base_url)['id']
+        journal.record(type='segment', file=vf, id=seg_id)
+    source_id = journal.sources.get(vf)
+    if source_id is None:
+        source_id = _create_source(seg_id, client_id, base_url)['id']
+        journal.record(type='source', file=vf, id=source_id)
+    if post_terms and vf not in journal.terms_posted:
+        _post_terminology_notifications(run_dir, base_url, vf, seg_id, client_id)
+        journal.record(type='terms', file=vf)
+    return source_id
+
+
+def _post_resource_validations(r, vf, source_future: concurrent.futures.Future, client_id, base_url,
+                               journal: TrackingJournal):
+    dest_id = journal.destinations.get((vf, r['id']))
+    if dest_id is None:
+        dest_id = _create_destination(r, source_future.result(), client_id, base_url)['id']
+        journal.record(type='destination', file=vf, resource=r['id'], id=dest_id)
+    _post_resource_notifications(base_url, dest_id, "DESTINATION", _validation_notifications(r, client_id))
+    journal.record(type='notified', file=vf, resource=r['id'])
+    return dest_id
+
+
+def _validation_notifications(r, client_id) -> typing.List[typing.Dict]:
     severity_map = {
         'information': 'INFO',
         'warning': 'WARNING',
         'error': 'ERROR'
     }
-    validation_files = os.listdir(os.path.join(run_dir, 'validated'))
-    for vf in validation_files:
-        track_seg = _create_segment(track_req['id'], client_id, base_url)
-        track_source = _create_source(track_seg['id'], client_id, base_url)
-        _post_terminology_notifications(run_dir, base_url, vf, track_seg['id'], client_id)
-        validation_file = os.path.join(run_dir, 'validated', vf)
-        with open(validation_file, 'r') as f:
-            data = json.load(f)
-            for r in data:
-                dest = _create_destination(r, track_source['id'], client_id, base_url)
-                notifications = []
-                for i in r['validations']['issue']:
-                    sev = severity_map[i['severity']]
-                    notification = {
-                        "phase": "VALIDATION",
-                        "systemId": client_id,
-                        "severity": sev,
-                        "type": "VALIDATION",
-                        "message": i['diagnostics'],
-                    }
-                    if 'location' in i:
-                        notification['location'] = json.dumps(i['location'])
-                    notifications.append(notification)
-                _post_resource_notifications(base_url, dest['id'], "DESTINATION", notifications)
+    notifications = []
+    for i in r['validations']['issue']:
+        sev = severity_map[i['severity']]
+        notification = {
+            "phase": "VALIDATION",
+            "systemId": client_id,
+            "severity": sev,
+            "type": "VALIDATION",
+            "message": i['diagnostics'],
+        }
+        if 'location' in i:
+            notification['location'] = json.dumps(i['location'])
+        notifications.append(notification)
+    return notifications
 
 
 def _create_destination(resource, ref_id, client_id, base_url):
     data = {"processType": "DESTINATION", "processAction": "CREATE", "clientId": client_id, "resourceId": resource['id'], "refId": ref_id}
-    r = requests.post(base_url + '/track/create', json=data)
+    r = tracking_client().request('POST', base_url + '/track/create', metric='tracking.create_destination',
+                                   idempotent=False, json=data)
     if r.status_code not in (200, 201):
         raise ApiException(f"Non-success status code from tracking-service: {r.status_code}, body is {r.text}")
     return r.json()
@@ -476,7 +2451,8 @@ def _create_destination(resource, ref_id, client_id, base_url):
 
 def _create_request(client_id, base_url):
     data = {"processType": "REQUEST", "processAction": "CREATE", "clientId": client_id, "reqType": "API"}
-    r = requests.post(base_url + '/track/create', json=data)
+    r = tracking_client().request('POST', base_url + '/track/create', metric='tracking.create_request',
+                                   idempotent=False, json=data)
     if r.status_code not in (200, 201):
         raise ApiException(f"Non-success status code from tracking-service: {r.status_code}, body is {r.text}")
     return r.json()
@@ -484,7 +2460,8 @@ def _create_request(client_id, base_url):
 
 def _create_segment(req_id, client_id, base_url):
     data = {"processType": "SEGMENT", "processAction": "CREATE", "clientId": client_id, "refId": req_id}
-    r = requests.post(base_url + '/track/create', json=data)
+    r = tracking_client().request('POST', base_url + '/track/create', metric='tracking.create_segment',
+                                   idempotent=False, json=data)
     if r.status_code not in (200, 201):
         raise ApiException(f"Non-success status code from tracking-service: {r.status_code}, body is {r.text}")
     return r.json()
@@ -492,7 +2469,8 @@ def _create_segment(req_id, client_id, base_url):
 
 def _create_source(seg_id, client_id, base_url):
     data = {"processType": "SOURCE", "processAction": "CREATE", "clientId": client_id, "refId": seg_id}
-    r = requests.post(base_url + '/track/create', json=data)
+    r = tracking_client().request('POST', base_url + '/track/create', metric='tracking.create_source',
+                                   idempotent=False, json=data)
     if r.status_code not in (200, 201):
         raise ApiException(f"Non-success status code from tracking-service: {r.status_code}, body is {r.text}")
     return r.json()
@@ -504,7 +2482,8 @@ def _post_resource_notifications(base_url, ref_id, ref_type, notifications):
         "referenceId": ref_id,
         "notifications": notifications
     }
-    r = requests.post(base_url + '/track/notifications', json=notification_req)
+    r = tracking_client().request('POST', base_url + '/track/notifications',
+                                  metric=f"tracking.post_{ref_type.lower()}_notifications", json=notification_req)
     if r.status_code not in (200, 201):
         raise ApiException(f"Non-success status code from tracking-service: {r.status_code}, body is {r.text}")
     return r.json()
@@ -512,27 +2491,111 @@ def _post_resource_notifications(base_url, ref_id, ref_type, notifications):
 
 def _post_terminology_notifications(run_dir, base_url, file_name, seg_id, client_id):
     term_file = os.path.join(run_dir, 'term_notifications', file_name)
-    with open(term_file, 'r') as tf:
-        terms = json.load(tf)
-        unmapped = [term for term in terms if term['mappingStatus'] == 'UNMAPPED']
-        if not unmapped:
-            return
-        notifications = []
-        for term in unmapped:
-            notification = {
-                "phase": "STANDARDIZATION",
-                "systemId": client_id,
-                "severity": "ERROR",
-                "type": "TERMINOLOGY",
-                "message": f"Could not map term {term['originalTerm']}",
-                "originalCode": term['originalCode'],
-                "originalTerm": term["originalTerm"],
-                "originalCodeSystem": term["originalCodeSystem"],
-                "mapReference": term["mapReference"],
-                "category": term["category"],
-            }
-            notifications.append(notification)
+    unmapped = [term for term in iter_json_array(term_file) if term['mappingStatus'] == 'UNMAPPED']
+    if not unmapped:
+        return
+    notifications = [_terminology_notification(term, client_id) for term in unmapped]
+    _post_resource_notifications(base_url, seg_id, "SEGMENT", notifications)
+
+
+def _terminology_notification(term: typing.Dict, client_id, message=None) -> typing.Dict:
+    return {
+        "phase": "STANDARDIZATION",
+        "systemId": client_id,
+        "severity": "ERROR",
+        "type": "TERMINOLOGY",
+        "message": message or f"Could not map term {term['originalTerm']}",
+        "originalCode": term['originalCode'],
+        "originalTerm": term["originalTerm"],
+        "originalCodeSystem": term["originalCodeSystem"],
+        "mapReference": term["mapReference"],
+        "category": term["category"],
+    }
+
+
+def unmapped_terms_subcmd(args):
+    terms = aggregate_unmapped_terms(args.run_dir, args.workers, use_cache=not args.no_cache)
+    print_unmapped_terms(terms, args.top)
+    if args.output:
+        _write_atomic(args.output, json.dumps(terms, indent=2))
+        print(f"INFO: Wrote {len(terms)} unmapped terms to {args.output}")
+    if args.post:
+        configure_tracking_client(max_retries=args.max_retries)
+        post_unmapped_terms(terms, args.tracking_service_base_url, args.client_id, args.notifications_per_request)
+
+
+def aggregate_unmapped_terms(run_dir, workers=1, use_cache=True) -> typing.List[typing.Dict]:
+    # The same unmapped local code shows up for thousands of patients, so terms are deduplicated by
+    # (originalCodeSystem, originalCode, category) and ranked by how often they occur
+    term_dir = os.path.join(run_dir, 'term_notifications')
+    term_files = [os.path.join(term_dir, tf) for tf in os.listdir(term_dir)]
+    cache = open_cache(run_dir) if use_cache else None
+    terms = {}
+    for partial in cached_map(unmapped_terms_file, 'unmapped_terms', term_files, num_workers(workers), cache):
+        for system, code, category, occurrences, original_term, map_reference in partial:
+            t = terms.get((system, code, category))
+            if t is None:
+                terms[(system, code, category)] = {
+                    'originalCodeSystem': system,
+                    'originalCode': code,
+                    'category': category,
+                    'originalTerm': original_term,
+                    'mapReference': map_reference,
+                    'occurrences': occurrences,
+                    'files': 1,
+                }
+            else:
+                t['occurrences'] += occurrences
+                t['files'] += 1
+    return sorted(terms.values(), key=lambda t: (-t['occurrences'], -t['files'], str(t['originalCodeSystem']),
+                                                 str(t['originalCode']), str(t['category'])))
+
+
+def unmapped_terms_file(term_file: str) -> typing.List:
+    # Terms are returned as [system, code, category, occurrences, term, map reference] lists so they can be cached
+    # as JSON; the first term text and map reference seen for a key are kept
+    terms = {}
+    for term in iter_json_array(term_file):
+        if term['mappingStatus'] != 'UNMAPPED':
+            continue
+        key = (term['originalCodeSystem'], term['originalCode'], term['category'])
+        t = terms.get(key)
+        if t is None:
+            terms[key] = [*key, 1, term['originalTerm'], term['mapReference']]
+        else:
+            t[3] += 1
+    return list(terms.values())
+
+
+def print_unmapped_terms(terms: typing.List[typing.Dict], top: int):
+    occurrences = sum(t['occurrences'] for t in terms)
+    print(f"Distinct unmapped terms = {len(terms)}, occurrences = {occurrences}")
+    print()
+    shown = terms[:top] if top > 0 else terms
+    print(f"Top {len(shown)} unmapped terms")
+    print("=====================")
+    print('%-11s' % 'occurrences', '%-6s' % 'files', '%-24s' % 'system', '%-16s' % 'code', '%-12s' % 'category',
+          'term')
+    for t in shown:
+        print('%-11s' % t['occurrences'], '%-6s' % t['files'], '%-24s' % t['originalCodeSystem'],
+              '%-16s' % t['originalCode'], '%-12s' % t['category'], t['originalTerm'])
+
+
+def post_unmapped_terms(terms: typing.List[typing.Dict], base_url, client_id, notifications_per_request=1000):
+    # One notification per distinct term under a single request and segment, instead of one per occurrence under
+    # every file's segment
+    start = time.time()
+    req_id = _create_request(client_id, base_url)['id']
+    seg_id = _create_segment(req_id, client_id, base_url)['id']
+    chunk_size = max(notifications_per_request, 1)
+    for i in range(0, len(terms), chunk_size):
+        notifications = [_terminology_notification(
+            t, client_id, f"Could not map term {t['originalTerm']} ({t['occurrences']} occurrences in {t['files']} files)")
+            for t in terms[i:i + chunk_size]]
         _post_resource_notifications(base_url, seg_id, "SEGMENT", notifications)
+    occurrences = sum(t['occurrences'] for t in terms)
+    print(f"INFO: Posted {len(terms)} unmapped terms ({occurrences} occurrences) to segment {seg_id} of request "
+          f"{req_id} in {-(-len(terms) // chunk_size)} requests, {time.time() - start:.2f} seconds")
 
 if __name__ == '__main__':
     main(sys.argv[1:])